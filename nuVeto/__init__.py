@@ -1 +1 @@
-__all__ = ['mu', 'utils', 'nuveto', 'barr_uncertainties', 'external','examples']
+__all__ = ['mu', 'utils', 'nuveto', 'barr_uncertainties', 'external','examples', 'store', 'ensemble', 'evaluator', 'table', 'surrogate', 'kernels', 'datafile', 'binned']
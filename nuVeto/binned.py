@@ -0,0 +1,157 @@
+"""Bin-averaged passing fractions
+
+Analyses consume passing fractions averaged over bins rather than at points.
+The passed and total fluxes are integrated over each bin with nested
+Clenshaw-Curtis rules, the coarser one on every other node estimating the
+integration error, and their ratio is the flux-weighted passing fraction of
+the bin.
+"""
+
+import numpy as np
+from nuVeto import nuveto
+
+
+def clenshaw_curtis(n):
+    """Increasing nodes on [-1, 1] and weights of the Clenshaw-Curtis rule
+    with n intervals, n even or 1
+    """
+    k = np.arange(n+1)
+    weights = np.ones(n+1)
+    for j in range(1, n//2+1):
+        weights -= (1. if 2*j == n else 2.)/(4*j**2-1)*np.cos(2*np.pi*j*k/n)
+    weights *= np.where((k == 0) | (k == n), 1., 2.)/n
+    return np.cos(np.pi*k/n)[::-1], weights[::-1]
+
+
+def quadrature(edges, order):
+    """Nodes of every bin of edges and the weights of the Clenshaw-Curtis rules
+    with order and order/2 intervals, the second on every other node
+
+    The outer nodes of each bin are its edges exactly, so neighbouring bins
+    share them.
+    """
+    if order < 2 or order % 2:
+        raise ValueError('order must be even and at least 2, not {}'.format(order))
+    nodes, weights = clenshaw_curtis(order)
+    coarse = np.zeros(order+1)
+    coarse[::2] = clenshaw_curtis(order//2)[1]
+    bins = []
+    for lo, hi in zip(edges[:-1], edges[1:]):
+        pts = (lo+hi)/2.+(hi-lo)/2.*nodes
+        pts[0], pts[-1] = lo, hi
+        bins.append((pts, weights*(hi-lo)/2., coarse*(hi-lo)/2.))
+    return bins
+
+
+def compute(task):
+    enus, cos_theta, kind, args = task
+    res = [nuveto.fluxes(enu, cos_theta, kind, **args) for enu in enus]
+    if args['rtol'] is not None:
+        res = [val for val, report in res]
+    return cos_theta, res
+
+
+def node_fluxes(enus, cos_thetas, kind, args, nproc=1, store=None):
+    """Returns {cos_theta: [(passed, total) for each enu]}, one task per
+    cos_theta so each MCEq run is built once
+    """
+    vals = dict((cos_theta, [None]*len(enus)) for cos_theta in cos_thetas)
+    if store is not None:
+        for cos_theta in cos_thetas:
+            vals[cos_theta] = store.get_many([dict(args, kind=kind, cos_theta=cos_theta, enu=enu) for enu in enus])
+    tasks = [(enus, cos_theta, kind, args) for cos_theta in cos_thetas if None in vals[cos_theta]]
+    with nuveto.workers(min(nproc, len(tasks))) as imap:
+        results = list(imap(compute, tasks))
+    for cos_theta, res in results:
+        vals[cos_theta] = res
+        if store is not None:
+            store.put_many([(dict(args, kind=kind, cos_theta=cos_theta, enu=enu), val)
+                            for enu, val in zip(enus, res)])
+    return vals
+
+
+def check(kind, kwargs):
+    """Returns the fluxes arguments of kwargs with the defaults"""
+    args = nuveto.check(kwargs, 'Bins')
+    if not isinstance(kind, str) or isinstance(args['prpl'], (list, tuple)):
+        raise TypeError('Bins are averaged for a single kind and prpl')
+    return args
+
+
+def average(bins, nodes, widths):
+    """Bin averages of the (passed, total) at the nodes of each bin
+
+    Returns:
+        passed and total averaged over widths, passed/total and the error of
+        passed/total, with the errors of passed and total added linearly
+    """
+    passed = np.array([np.dot(weights, node[..., 0]) for (pts, weights, coarse), node in zip(bins, nodes)])
+    total = np.array([np.dot(weights, node[..., 1]) for (pts, weights, coarse), node in zip(bins, nodes)])
+    passed_err = np.array([np.dot(weights-coarse, node[..., 0]) for (pts, weights, coarse), node in zip(bins, nodes)])
+    total_err = np.array([np.dot(weights-coarse, node[..., 1]) for (pts, weights, coarse), node in zip(bins, nodes)])
+    fraction = passed/total
+    error = np.abs(passed_err/total) + np.abs(fraction*total_err/total)
+    widths = np.reshape(widths, (-1,)+(1,)*(passed.ndim-1))
+    return passed/widths, total/widths, fraction, error
+
+
+def cos_theta_bins(enus, cos_theta_edges, kind='conv_numu', order=4, nproc=1, store=None, **kwargs):
+    """Flux-weighted passing fractions averaged over the solid angle of
+    cos_theta bins
+
+    Every quadrature node is one MCEq run, evaluated for all enus, and the
+    nodes at the bin edges are shared by neighbouring bins, so n bins take
+    n*order+1 runs.
+
+    Args:
+        cos_theta_edges: increasing bin edges
+        order (int): intervals of the Clenshaw-Curtis rule per bin, even
+        nproc (int): number of processes, over the nodes
+        store (ResultStore): if given, node values are looked up in and added
+        to this store
+        kwargs: the other arguments of nuveto.fluxes
+    Returns:
+        dict of enus, cos_theta_edges, passed and total (the bin-averaged
+        fluxes), fraction (the passing fraction) and error (its estimated
+        integration error), with shape (bins, enus)
+    """
+    args = check(kind, kwargs)
+    enus = np.atleast_1d(enus)
+    bins = quadrature(np.asarray(cos_theta_edges, dtype=float), order)
+    vals = node_fluxes(enus, sorted(set(np.concatenate([pts for pts, w, c in bins]))), kind, args, nproc, store)
+
+    passed, total, fraction, error = average(bins, [np.array([vals[pt] for pt in pts]) for pts, w, c in bins],
+                                             np.diff(cos_theta_edges))
+    return {'enus':enus, 'cos_theta_edges':np.asarray(cos_theta_edges), 'passed':passed, 'total':total,
+            'fraction':fraction, 'error':error}
+
+
+def enu_bins(enu_edges, cos_theta, kind='conv_numu', order=4, store=None, **kwargs):
+    """Flux-weighted passing fractions averaged over enu bins
+
+    The passed and total fluxes are integrated over log(enu) in each bin with
+    the Clenshaw-Curtis rules of cos_theta_bins. All nodes are evaluated in
+    one pass on the nuVeto object of cos_theta, so the grid solutions, nmu and
+    mother fluxes are computed once for all bins.
+
+    Args:
+        enu_edges: increasing bin edges
+        order (int): intervals of the Clenshaw-Curtis rule per bin, even
+        store (ResultStore): if given, node values are looked up in and added
+        to this store
+        kwargs: the other arguments of nuveto.fluxes
+    Returns:
+        dict of enu_edges, cos_theta, passed and total (the bin-averaged
+        fluxes), fraction (the passing fraction) and error (its estimated
+        integration error), with shape (bins,)
+    """
+    args = check(kind, kwargs)
+    bins = quadrature(np.log(np.asarray(enu_edges, dtype=float)), order)
+    lenus = sorted(set(np.concatenate([pts for pts, w, c in bins])))
+    vals = dict(zip(lenus, node_fluxes(np.exp(lenus), [cos_theta], kind, args, store=store)[cos_theta]))
+    # dE = E dlog(E)
+    passed, total, fraction, error = average(bins, [np.array([vals[pt] for pt in pts])*np.exp(pts)[:,None]
+                                                    for pts, w, c in bins],
+                                             np.diff(enu_edges))
+    return {'enu_edges':np.asarray(enu_edges), 'cos_theta':cos_theta, 'passed':passed, 'total':total,
+            'fraction':fraction, 'error':error}
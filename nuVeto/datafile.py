@@ -0,0 +1,197 @@
+"""Versioned, memory-mappable format of the bundled data
+
+A data file holds named arrays and JSON metadata:
+
+    MAGIC, format version (uint16), header length (uint64), JSON header,
+    arrays at ALIGN byte boundaries
+
+The header records the dtype, shape and offset of each array, so the arrays
+are memory-mapped read-only on load. The metadata tells unpack how to rebuild
+the object the file stands for, e.g. the RegularGridInterpolator of a prpl,
+and is all there is to files without arrays such as the particle snapshot.
+load is the cached loader of all resources in nuVeto/data. It also reads the
+legacy pickle, npz and json files, which convert turns into data files.
+"""
+
+import os
+import sys
+import json
+import pickle
+import struct
+from contextlib import contextmanager
+from functools32 import lru_cache
+from pkg_resources import resource_filename
+import numpy as np
+from scipy import interpolate
+
+
+MAGIC = b'NUVETO'
+VERSION = 1
+ALIGN = 64
+EXT = '.nvd'
+LEGACY = ('.pkl', '.npz', '.json')
+
+
+class DataFile(object):
+    """Named arrays and metadata of a data file"""
+    def __init__(self, arrays, meta, version=VERSION):
+        self.arrays = arrays
+        self.meta = meta
+        self.version = version
+
+
+    def __getitem__(self, name):
+        return self.arrays[name]
+
+
+    @property
+    def files(self):
+        return sorted(self.arrays)
+
+
+    def unpack(self):
+        """Rebuilds the object of the file according to meta['type']
+
+        'RegularGridInterpolator' returns the interpolator, 'tuples' a dict of
+        tuples of arrays and 'arrays' the dict of arrays.
+        """
+        kind = self.meta.get('type', 'arrays')
+        if kind == 'RegularGridInterpolator':
+            grid = tuple(self['grid{}'.format(idx)] for idx in range(self.meta['ndim']))
+            return interpolate.RegularGridInterpolator(grid, self['values'], method=self.meta['method'],
+                                                       bounds_error=self.meta['bounds_error'],
+                                                       fill_value=self.meta['fill_value'])
+        elif kind == 'tuples':
+            return dict((key, tuple(self['{}/{}'.format(key, idx)] for idx in range(size)))
+                        for key, size in self.meta['sizes'].items())
+        return dict(self.arrays)
+
+
+def pad(size):
+    return -(-size//ALIGN)*ALIGN
+
+
+@contextmanager
+def atomic(fpath):
+    """Yields a binary file that replaces fpath once it is written
+
+    The file is written next to fpath and renamed, so readers of fpath, also
+    in other processes, see either the old or the complete new file.
+    """
+    tmp = '{}.{}.tmp'.format(fpath, os.getpid())
+    try:
+        with open(tmp, 'wb') as f:
+            yield f
+        os.rename(tmp, fpath)
+    finally:
+        if os.path.isfile(tmp):
+            os.remove(tmp)
+
+
+def write(fpath, arrays, meta=None):
+    """Writes the dict of arrays and the JSON serializable meta to fpath"""
+    header = {'version':VERSION, 'meta':meta or {}, 'arrays':{}}
+    offset = 0
+    arrays = dict((name, np.ascontiguousarray(arr)) for name, arr in arrays.items())
+    for name in sorted(arrays):
+        header['arrays'][name] = {'dtype':arrays[name].dtype.str,
+                                  'shape':list(arrays[name].shape),
+                                  'offset':offset}
+        offset += pad(arrays[name].nbytes)
+    text = json.dumps(header, sort_keys=True).encode()
+    start = pad(len(MAGIC)+10+len(text))
+    with atomic(fpath) as f:
+        f.write(MAGIC)
+        f.write(struct.pack('<HQ', VERSION, len(text)))
+        f.write(text)
+        f.write(b'\0'*(start-f.tell()))
+        for name in sorted(arrays):
+            f.write(arrays[name].tobytes())
+            f.write(b'\0'*(pad(arrays[name].nbytes)-arrays[name].nbytes))
+
+
+def read(fpath):
+    """Returns the DataFile in fpath with its arrays memory-mapped"""
+    with open(fpath, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise IOError('{} is not a nuVeto data file'.format(fpath))
+        version, size = struct.unpack('<HQ', f.read(10))
+        if version > VERSION:
+            raise IOError('{} has format version {}, this nuVeto reads up to {}'.format(fpath, version, VERSION))
+        header = json.loads(f.read(size).decode())
+    start = pad(len(MAGIC)+10+size)
+    arrays = {}
+    for name, spec in header['arrays'].items():
+        shape = tuple(spec['shape'])
+        if np.prod(shape) == 0:
+            arrays[name] = np.zeros(shape, spec['dtype'])
+        else:
+            arrays[name] = np.memmap(fpath, spec['dtype'], 'r', start+spec['offset'], shape)
+    return DataFile(arrays, header['meta'], version)
+
+
+def legacy(fpath):
+    """Returns the (arrays, meta) of a legacy pickle, npz or json resource"""
+    if fpath.endswith('.json'):
+        with open(fpath) as f:
+            return {}, json.load(f)
+    elif fpath.endswith('.npz'):
+        with np.load(fpath) as dfile:
+            return dict((name, dfile[name]) for name in dfile.files), {'type':'arrays'}
+    with open(fpath, 'rb') as f:
+        return pack(pickle.load(f))
+
+
+def pack(obj):
+    """Returns the (arrays, meta) of an object that unpack rebuilds"""
+    if isinstance(obj, interpolate.RegularGridInterpolator):
+        arrays = dict(('grid{}'.format(idx), grid) for idx, grid in enumerate(obj.grid))
+        arrays['values'] = obj.values
+        fill_value = obj.fill_value
+        return arrays, {'type':'RegularGridInterpolator', 'ndim':len(obj.grid), 'method':obj.method,
+                        'bounds_error':obj.bounds_error,
+                        'fill_value':None if fill_value is None else float(fill_value)}
+    elif isinstance(obj, dict):
+        arrays = {}
+        for key, vals in obj.items():
+            for idx, val in enumerate(vals):
+                arrays['{}/{}'.format(key, idx)] = val
+        return arrays, {'type':'tuples', 'sizes':dict((key, len(vals)) for key, vals in obj.items())}
+    raise TypeError('Cannot pack {}'.format(type(obj)))
+
+
+def convert(fpath, outpath=None):
+    """Converts a legacy resource to a data file, by default next to it with EXT"""
+    if outpath is None:
+        outpath = os.path.splitext(fpath)[0]+EXT
+    write(outpath, *legacy(fpath))
+    return outpath
+
+
+def locate(name):
+    """Returns the path of a resource, name is a path or relative to nuVeto/data
+    without extension, e.g. 'prpl/ice_allm97_step_1'
+    """
+    if os.path.isfile(name):
+        return name
+    for ext in (EXT,)+LEGACY:
+        fpath = resource_filename('nuVeto', os.path.join('data', name+ext))
+        if os.path.isfile(fpath):
+            return fpath
+    raise IOError('No resource {}'.format(name))
+
+
+@lru_cache(maxsize=2**8)
+def load(name):
+    """Returns the DataFile of a resource, see locate, read once per process"""
+    fpath = locate(name)
+    with open(fpath, 'rb') as f:
+        if f.read(len(MAGIC)) == MAGIC:
+            return read(fpath)
+    return DataFile(*legacy(fpath))
+
+
+if __name__ == '__main__':
+    # python -m nuVeto.datafile FILE [FILE ...]
+    for fpath in sys.argv[1:]:
+        print('Converted {} into {}'.format(fpath, convert(fpath)))
@@ -0,0 +1,170 @@
+"""Passing fractions over an ensemble of model configurations
+
+Uncertainty bands are made of the same (enu, cos_theta) grid evaluated for
+many CR, hadronic, density or Barr configurations. run schedules the grid
+across processes, keeping the configurations that share an MCEq run (same
+cos_theta, pmodel, hadr, barr_mods, depth, density and xtol) on the same worker, so
+each MCEq run is built once and kind and prpl variations are evaluated in one
+pass.
+With a solutions directory the grid solutions of each MCEq run are instead
+published once and the enus are split across all workers, which attach to the
+solutions read-only through memory maps.
+"""
+
+import numpy as np
+from nuVeto import nuveto
+from nuVeto.store import canonical
+
+
+BUILDER_ARGS = ('cos_theta', 'pmodel', 'hadr', 'barr_mods', 'depth', 'density', 'xtol')
+
+
+class EnsembleResult(object):
+    """Passed and total fluxes with shape (configurations, cos_thetas, enus)"""
+    def __init__(self, labels, configs, enus, cos_thetas, passed, total):
+        self.labels = labels
+        self.configs = configs
+        self.enus = enus
+        self.cos_thetas = cos_thetas
+        self.passed = passed
+        self.total = total
+
+
+    @property
+    def fraction(self):
+        return self.passed/self.total
+
+
+    def __getitem__(self, label):
+        """Passing fractions of the configuration label"""
+        return self.fraction[self.labels.index(label)]
+
+
+    def summary(self, fraction=True):
+        """Statistics over the configurations
+
+        Returns:
+            dict of mean, std, median, min and max with shape (cos_thetas, enus)
+        """
+        vals = self.fraction if fraction else self.passed
+        return {'mean':np.mean(vals, axis=0),
+                'std':np.std(vals, axis=0),
+                'median':np.median(vals, axis=0),
+                'min':np.min(vals, axis=0),
+                'max':np.max(vals, axis=0)}
+
+
+def freeze(value):
+    """Lists as tuples, e.g. barr_mods, as the cached builders need hashable arguments"""
+    if isinstance(value, (list, tuple)):
+        return tuple(freeze(val) for val in value)
+    return value
+
+
+def tasks(configs, cos_thetas):
+    """Groups the points by the MCEq run they need
+
+    Returns:
+        list of (BUILDER_ARGS values, calls), calls is a list of (the other
+        fluxes arguments without enu, kind and prpl, points) and points the
+        (kind, prpl, slot) of each point, slot being its (configuration,
+        cos_theta) indices
+    """
+    groups = {}
+    for iconf, config in enumerate(configs):
+        for icth, cos_theta in enumerate(cos_thetas):
+            args = dict(nuveto.DEFAULTS)
+            args.update((arg, freeze(val)) for arg, val in config.items())
+            args['cos_theta'] = cos_theta
+            kind, prpl = args.pop('kind'), args.pop('prpl')
+            build = dict((arg, args.pop(arg)) for arg in BUILDER_ARGS)
+            group = groups.setdefault(canonical(tuple(build[arg] for arg in BUILDER_ARGS)), (build, {}))
+            call = group[1].setdefault(canonical(tuple(sorted(args.items()))), (args, []))
+            call[1].append((kind, prpl, (iconf, icth)))
+    groups = [(build, list(calls.values())) for build, calls in groups.values()]
+    # largest groups first to balance the workers
+    return sorted(groups, key=lambda group: -sum(len(points) for args, points in group[1]))
+
+
+def attach(path):
+    """Makes the nuVeto objects of this process use the solutions in path"""
+    nuveto.SOLUTIONS = path
+
+
+def publish(group):
+    """Publishes the grid solutions of a group at the accuracies of its calls"""
+    build, calls = group
+    sv = nuveto.builder(*[build[arg] for arg in BUILDER_ARGS])
+    for accuracy in sorted(set(args['accuracy'] for args, points in calls)):
+        sv.publish(nuveto.SOLUTIONS, accuracy)
+
+
+def evaluate(task):
+    """Evaluates a group of points on the enus with indices ienus
+
+    Returns:
+        (slots, ienus, fluxes with shape (points, enus, 2))
+    """
+    build, calls, enus, ienus = task
+    slots = []
+    res = []
+    for args, points in calls:
+        # the kinds and prpls of a call are evaluated in one pass, repeated ones once
+        kinds = sorted(set(kind for kind, prpl, slot in points))
+        prpls = []
+        for kind, prpl, slot in points:
+            if prpl not in prpls:
+                prpls.append(prpl)
+        vals = [nuveto.fluxes(enu, kind=kinds, prpl=prpls, **dict(build, **args)) for enu in enus[ienus]]
+        if args['rtol'] is not None:
+            vals = [val for val, report in vals]
+        for kind, prpl, slot in points:
+            slots.append(slot)
+            res.append([val[kind][prpls.index(prpl)] for val in vals])
+    return slots, ienus, np.array(res)
+
+
+def run(configs, enus, cos_thetas, nproc=1, labels=None, solutions=None):
+    """Computes the passing fluxes of each configuration on the (cos_theta, enu) grid
+
+    Args:
+        configs (list(dict)): arguments of nuveto.fluxes, e.g.
+        {'pmodel':('GaisserHonda', None), 'hadr':'DPMJET-III'}, defaults for
+        the rest. A 'label' entry names the configuration
+        enus, cos_thetas: the grid
+        nproc (int): number of processes
+        labels (list(str)): names of the configurations, defaults to the
+        'label' entries or the configurations themselves
+        solutions (str): directory to publish the grid solutions to when
+        nproc > 1, see nuVeto.publish
+    Returns:
+        EnsembleResult
+    """
+    configs = [dict(config) for config in configs]
+    if labels is None:
+        labels = [config.pop('label', repr(sorted(config.items()))) for config in configs]
+    else:
+        for config in configs:
+            config.pop('label', None)
+    enus = np.atleast_1d(enus)
+    cos_thetas = np.atleast_1d(cos_thetas)
+    configs = [nuveto.check(config, 'Ensembles', ()) for config in configs]
+
+    passed = np.zeros((len(configs), len(cos_thetas), len(enus)))
+    total = np.zeros(passed.shape)
+    groups = tasks(configs, cos_thetas)
+    shared = nproc > 1 and solutions is not None
+    if shared:
+        chunks = np.array_split(np.arange(len(enus)), min(nproc, len(enus)))
+    else:
+        chunks = [np.arange(len(enus))]
+    todo = [(build, calls, enus, ienus) for build, calls in groups for ienus in chunks]
+    with nuveto.workers(nproc, attach if shared else None, (solutions,)) as imap:
+        if shared:
+            list(imap(publish, groups))
+        results = list(imap(evaluate, todo))
+    for slots, ienus, res in results:
+        for islot, (iconf, icth) in enumerate(slots):
+            passed[iconf, icth, ienus] = res[islot, :, 0]
+            total[iconf, icth, ienus] = res[islot, :, 1]
+    return EnsembleResult(labels, configs, enus, cos_thetas, passed, total)
@@ -0,0 +1,95 @@
+"""Thread-safe evaluation of passing fractions and fluxes
+
+Evaluator runs nuveto.fluxes on a pool of threads that each hold their own
+nuVeto objects, and thus their own MCEq state. Requests return futures and
+identical requests that are in flight share one future, so duplicate queries
+are computed once. In an asyncio service the futures are awaited with
+asyncio.wrap_future.
+"""
+
+import inspect
+import threading
+from concurrent.futures import ThreadPoolExecutor, Future
+from nuVeto import nuveto
+from nuVeto.store import key
+
+
+class Evaluator(object):
+    """Concurrent front end to nuveto.fluxes and nuveto.passing"""
+    def __init__(self, max_workers=4):
+        """
+        Args:
+            max_workers (int): number of threads, each with its own MCEq runs
+        """
+        self.executor = ThreadPoolExecutor(max_workers)
+        self.local = threading.local()
+        self.lock = threading.RLock()
+        self.inflight = {}
+
+
+    def builder(self, cos_theta, pmodel, hadr, barr_mods, depth, density, xtol=None):
+        """nuVeto object of the calling thread"""
+        if not hasattr(self.local, 'builders'):
+            self.local.builders = {}
+        args = (cos_theta, pmodel, hadr, barr_mods, depth, density, xtol)
+        if args not in self.local.builders:
+            self.local.builders[args] = nuveto.nuVeto(*args)
+        return self.local.builders[args]
+
+
+    def compute(self, args):
+        sv = self.builder(*[args[arg] for arg in
+                            ('cos_theta', 'pmodel', 'hadr', 'barr_mods', 'depth', 'density', 'xtol')])
+        return sv.get_fluxes(args['enu'], args['kind'], args['accuracy'], args['prpl'], args['corr_only'],
+                             rtol=args['rtol'], matrices=args['matrices'], auto_rtol=args['auto_rtol'])
+
+
+    def fluxes(self, *args, **kwargs):
+        """Submits nuveto.fluxes, without store, and returns its future"""
+        args = inspect.getcallargs(nuveto.fluxes, *args, **kwargs)
+        if args.pop('store') is not None:
+            raise TypeError('Evaluator does not support a store')
+        k = key(**args)
+        with self.lock:
+            future = self.inflight.get(k)
+            if future is None:
+                future = self.executor.submit(self.compute, args)
+                self.inflight[k] = future
+                future.add_done_callback(lambda done: self.finished(k))
+        return future
+
+
+    def finished(self, k):
+        with self.lock:
+            self.inflight.pop(k, None)
+
+
+    def passing(self, *args, **kwargs):
+        """Submits nuveto.passing, without store, and returns its future"""
+        args = inspect.getcallargs(nuveto.passing, *args, **kwargs)
+        fraction = args.pop('fraction')
+        flux = self.fluxes(**args)
+        future = Future()
+        def done(flux):
+            try:
+                if nuveto.reported(args['accuracy'], args['rtol']):
+                    res, report = flux.result()
+                    future.set_result((nuveto.to_passing(res, args['kind'], args['prpl'], fraction), report))
+                else:
+                    future.set_result(nuveto.to_passing(flux.result(), args['kind'], args['prpl'], fraction))
+            except Exception as e:
+                future.set_exception(e)
+        flux.add_done_callback(done)
+        return future
+
+
+    def shutdown(self, wait=True):
+        self.executor.shutdown(wait)
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *exc):
+        self.shutdown()
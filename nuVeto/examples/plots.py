@@ -1,11 +1,10 @@
-import pickle
 import os
-from pkg_resources import resource_filename
 from nuVeto.external import helper as exthp
 from nuVeto.external import selfveto as extsv
 from nuVeto.nuveto import nuVeto, passing, fluxes
 from nuVeto.utils import Units, ParticleProperties, amu, centers, Geometry, calc_bins
 from nuVeto.uncertainties import BARR
+from nuVeto import datafile
 from matplotlib import pyplot as plt
 from matplotlib import colors
 from matplotlib.ticker import LogLocator
@@ -17,6 +16,10 @@ except ImportError:
     import CRFluxModels as pm
 
 
+# set to a nuVeto.store.ResultStore to persist passing fractions across sessions
+store = None
+
+
 def tex(inp):
     if isinstance(inp, str):
         categ, daughter = inp.split('_')
@@ -50,7 +53,7 @@ def pr_enu(cos_theta=1., kind='conv_numu', pmodel=(pm.HillasGaisser2012, 'H3a'),
     """ plot the passing rate (flux or fraction)
     """
     ens = np.logspace(3,7,100) if corr_only else np.logspace(3,7,39)
-    passed = [passing(en, cos_theta, kind, pmodel, hadr, barr_mods, depth, density, accuracy, fraction, prpl, corr_only) for en in ens]
+    passed = [passing(en, cos_theta, kind, pmodel, hadr, barr_mods, depth, density, accuracy, fraction, prpl, corr_only, store) for en in ens]
     if fraction:
         passed_fn = interpolate.interp1d(ens, passed, kind='quadratic')
     else:
@@ -74,7 +77,7 @@ def pr_cth(enu=1e5, kind='conv_numu', pmodel=(pm.HillasGaisser2012, 'H3a'), hadr
     """ plot the passing rate (flux or fraction)
     """
     cths = np.linspace(0,1,21)
-    passed = [passing(enu, cos_theta, kind, pmodel, hadr, barr_mods, depth, density, accuracy, fraction, prpl, corr_only) for cos_theta in cths]
+    passed = [passing(enu, cos_theta, kind, pmodel, hadr, barr_mods, depth, density, accuracy, fraction, prpl, corr_only, store) for cos_theta in cths]
     if fraction:
         prs = plt.plot(cths, passed, **kwargs)
         plt.ylim(0., 1.)
@@ -213,7 +216,7 @@ def corsika(cos_theta_bin=-1, kind='conv_numu', pmodel=(pm.HillasGaisser2012, 'H
         [corsika(cth, kind, pmodel, hadr, density, prpl, corsika_file, plot_nuveto_lines, plot_legacy_veto_lines) for cth in cos_theta_bin]
         return
 
-    cfile = pickle.load(open(resource_filename('nuVeto', os.path.join('/data/corsika', corsika_file+'.pkl'))))
+    cfile = datafile.load(os.path.join('corsika', corsika_file)).unpack()
     fraction = 'eff' in corsika_file
     eff, elow, eup, xedges, yedges = cfile[kind]
     cos_theta = centers(yedges)[cos_theta_bin]
@@ -257,7 +260,7 @@ def dndee(mother, daughter):
 
 def plot_prpl(interp_pkl, include_mean=False, include_cbar=True):
     depth = 1950*Units.m
-    prplfn = pickle.load(open(interp_pkl))
+    prplfn = datafile.load(interp_pkl).unpack()
     emui_edges = np.logspace(2, 8, 101)
     l_ice_edges = np.linspace(1e3, 4e4, 101)
     emui = centers(emui_edges)
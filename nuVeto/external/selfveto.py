@@ -31,6 +31,7 @@ detector with no accompanying muons.
 # POSSIBILITY OF SUCH DAMAGE.
 
 import numpy
+from nuVeto import kernels
 
 def overburden(cos_theta, depth=1950, elevation=2400):
 	"""
@@ -117,12 +118,6 @@ def elbert_yield(emin, primary_energy, primary_mass, cos_theta, kind='mu', diffe
 	
 	:returns: either a differential yield [1/GeV] or cumulative yield [number]
 	"""
-	params = elbert_params[kind]
-	a  = params['a']
-	p1 = params['p1']
-	p2 = params['p2']
-	p3 = params['p3']
-	
 	En = primary_energy/primary_mass
 	x = emin/En
 	
@@ -131,12 +126,19 @@ def elbert_yield(emin, primary_energy, primary_mass, cos_theta, kind='mu', diffe
 	else:
 		decay_prob = 1./(En*effective_costheta(cos_theta))
 	
-	with fpe_context(all='ignore'):
-		icdf = numpy.where(x >= 1, 0., a*primary_mass*decay_prob*x**(-p1)*(1-x**p3)**p2)
-		if differential:
-			icdf *= (1./En)*numpy.where(x >= 1, 0., (p1/x + p2*p3*x**(p3-1)/(1-x**p3)))
+	return elbert_shape(x, primary_mass*decay_prob, 1./En, kind, differential)
+
+def elbert_shape(x, norm, inv_en, kind, differential):
+	"""
+	Evaluate the [Elbert]_ parameterization a*norm*x^-p1*(1-x^p3)^p2 of the
+	given family at x = E/E_N.
 	
-	return icdf
+	:param inv_en:       1/E_N, the derivative is taken with respect to E
+	:param differential: if True, evaluate the derivative
+	"""
+	params = elbert_params[kind]
+	with fpe_context(all='ignore'):
+		return kernels.elbert(x, params['a']*norm, inv_en, params['p1'], params['p2'], params['p3'], differential)
 
 class ParticleType(object):
 	PPlus       =   14
@@ -145,6 +147,28 @@ class ParticleType(object):
 	Al27Nucleus = 2713
 	Fe56Nucleus = 5626
 
+# particle type codes in the order of the H3a parameter tables
+PTYPE_CODES = sorted(filter(lambda v: isinstance(v, int), ParticleType.__dict__.values()))
+# (particle type, mass number) of the primaries summed over in the response function
+PRIMARIES = [(pt, [pt/100, 1][pt == ParticleType.PPlus]) for pt in
+             [getattr(ParticleType, name) for name in 'PPlus', 'He4Nucleus', 'N14Nucleus', 'Al27Nucleus', 'Fe56Nucleus']]
+
+# H3a normalizations, spectral indices and cutoff rigidities for each
+# population, with one entry per element in the order of PTYPE_CODES
+GAISSER_NORM = [
+	[7860., 3550., 2200., 1430., 2120.],
+	[20]*2 + [13.4]*3,
+	[1.7]*2 + [1.14]*3,
+]
+GAISSER_GAMMA = [
+	[2.66, 2.58, 2.63, 2.67, 2.63],
+	[2.4]*5,
+	[2.4]*5
+]
+GAISSER_RIGIDITY = [
+	4e6, 30e6, 2e9
+]
+
 def gaisser_flux(energy, ptype):
 	"""
 	Evaluate the [Gaisser]_ H3a parameterization of the cosmic ray flux.
@@ -156,32 +180,21 @@ def gaisser_flux(energy, ptype):
 	
 	.. [Gaisser] T. K. Gaisser. Spectrum of cosmic-ray nucleons, kaon production, and the atmospheric muon charge ratio. Astroparticle Physics, 35(12):801--806, 2012. ISSN 0927-6505. doi: 10.1016/j.astropartphys.2012.02.010.
 	"""
+	return sum(n*energy**(-g)*numpy.exp(-energy/rz) for n, g, rz in gaisser_terms(ptype))
+
+def gaisser_terms(ptype):
+	"""
+	:returns: the (normalization, spectral index, cutoff energy) of each H3a
+	          population for the given particle type
+	"""
 	if ptype < 100:
 		z = 1
 	else:
 		z = ptype % 100
 	
-	codes = sorted(filter(lambda v: isinstance(v, int), ParticleType.__dict__.values()))
-	idx = codes.index(ptype)
-	
-	# normalizations for each element
-	norm = [
-		[7860., 3550., 2200., 1430., 2120.],
-		[20]*2 + [13.4]*3,
-		[1.7]*2 + [1.14]*3,
-	]
-	# spectral indices
-	gamma = [
-		[2.66, 2.58, 2.63, 2.67, 2.63],
-		[2.4]*5,
-		[2.4]*5
-	]
-	# cutoff rigitity
-	rigidity = [
-		4e6, 30e6, 2e9
-	]
-	
-	return sum(n[idx]*energy**(-g[idx])*numpy.exp(-energy/(r*z)) for n, g, r in zip(norm, gamma, rigidity))
+	idx = PTYPE_CODES.index(ptype)
+	
+	return [(n[idx], g[idx], r*z) for n, g, r in zip(GAISSER_NORM, GAISSER_GAMMA, GAISSER_RIGIDITY)]
 
 def logspace(start, stop, num):
 	"""
@@ -219,9 +232,7 @@ def response_function(enu, emu, cos_theta, kind='numu'):
 	# mean integral muon yield from same chunks
 	muyield = numpy.zeros(shape+(5, 100))
 	energy_per_nucleon = logspace(numpy.log10(enu), numpy.log10(enu)+3, 101)
-	ptypes = [getattr(ParticleType, pt) for pt in 'PPlus', 'He4Nucleus', 'N14Nucleus', 'Al27Nucleus', 'Fe56Nucleus']
-	A = [[pt/100, 1][pt == ParticleType.PPlus] for pt in ptypes]
-	for i, (ptype, a) in enumerate(zip(ptypes, A)):
+	for i, (ptype, a) in enumerate(PRIMARIES):
 		# primary energies that contribute to the neutrino flux at given energy
 		penergy = a*energy_per_nucleon
 		# width of energy bins
@@ -237,7 +248,88 @@ def response_function(enu, emu, cos_theta, kind='numu'):
 	
 	return contrib, muyield, energy_per_nucleon[...,:-1] + numpy.diff(energy_per_nucleon)/2.
 
-def uncorrelated_passing_rate(enu, emu, cos_theta, kind='numu'):
+def chunked(fn, chunksize, *args):
+	"""
+	Evaluate an elementwise function of broadcastable array arguments in
+	blocks of at most chunksize elements
+	
+	:returns: an array with the broadcast shape of args
+	"""
+	args = numpy.broadcast_arrays(*map(numpy.asarray, args))
+	out = numpy.empty(args[0].shape)
+	flat_out = out.reshape(-1)
+	flat_args = [numpy.ravel(arg) for arg in args]
+	for start in range(0, flat_out.size, chunksize):
+		block = slice(start, start+chunksize)
+		flat_out[block] = fn(*[arg[block] for arg in flat_args])
+	return out
+
+def response_tables(kind='numu'):
+	"""
+	Precompute the event-independent factors of the response function. The
+	primary energy grid scales with the neutrino energy, so the H3a flux
+	weights and the neutrino yield factorize into a function of the relative
+	grid and a power of the neutrino energy.
+	
+	:param kind: lepton type, as in :func:`response_function`
+	
+	:returns: a list with one (mass number, flux terms, neutrino yield)
+	          tuple per primary
+	"""
+	x = 10**numpy.linspace(0, 3, 101)
+	xwidth = numpy.diff(x)
+	xcenter = x[:-1] + xwidth/2.
+	# x = E_nu/E_n is fixed on the relative grid for the neutrino yield, the
+	# factor 1/E_n is 1/(E_nu*xcenter)
+	nuyield = elbert_shape(1./xcenter, 1., 1./xcenter, kind, True)
+	if kind != 'charm':
+		nuyield /= xcenter
+	tables = []
+	for ptype, mass in PRIMARIES:
+		# the flux terms at E = mass*E_nu*xcenter are n*E^-g*exp(-E/rz)
+		fluxterms = [(n*xcenter**(-g)*xwidth, g, rz) for n, g, rz in gaisser_terms(ptype)]
+		tables.append((mass, fluxterms, mass*nuyield))
+	return xcenter, tables
+
+def uncorrelated_passing_rate_block(enu, emu, cos_theta, kind='numu', tables=None):
+	"""
+	Memory-bounded equivalent of :func:`uncorrelated_passing_rate` for 1-d
+	arrays of equal length. Instead of materializing the full response
+	function, the flux-weighted yields are accumulated one primary at a time
+	in buffers of shape (len(enu), 100).
+	
+	:param tables: output of :func:`response_tables`, computed if None
+	"""
+	xcenter, tables = response_tables(kind) if tables is None else tables
+	effcos = effective_costheta(cos_theta)
+	ratio = emu/enu
+	num = numpy.zeros(enu.shape)
+	den = numpy.zeros(enu.shape)
+	contrib = numpy.empty(enu.shape+(100,))
+	buf = numpy.empty(enu.shape+(100,))
+	with fpe_context(all='ignore'):
+		nudecay = 1./enu if kind == 'charm' else 1./(enu**2*effcos)
+		for mass, fluxterms, nuyield in tables:
+			# flux*de
+			contrib[:] = 0.
+			for fx, g, rz in fluxterms:
+				numpy.multiply((mass*enu/rz)[:,None], -xcenter, out=buf)
+				numpy.exp(buf, out=buf)
+				buf *= fx
+				buf *= ((mass*enu)**(1-g))[:,None]
+				contrib += buf
+			# neutrino yield
+			contrib *= nuyield
+			contrib *= nudecay[:,None]
+			# probability of no muons, the muon yield at E_n = E_nu*xcenter
+			pnomu = elbert_shape(ratio[:,None]/xcenter, mass/(enu*effcos)[:,None]/xcenter, 0., 'mu', False)
+			numpy.exp(-pnomu, out=pnomu)
+			den += contrib.sum(axis=-1)
+			pnomu *= contrib
+			num += pnomu.sum(axis=-1)
+	return num/den
+
+def uncorrelated_passing_rate(enu, emu, cos_theta, kind='numu', chunksize=None):
 	"""
 	Calculate the probability that neutrinos of the given energy and type will
 	be accompanied by at least one muon from an unrelated branch of the shower.
@@ -249,7 +341,13 @@ def uncorrelated_passing_rate(enu, emu, cos_theta, kind='numu'):
 	                  "numu" for muon neutrinos from pion/kaon decay, "nue" for
 	                  electron neutrinos from kaon decay, or "charm" for either
 	                  flavor from charmed meson decay
+	:param chunksize: if not None, evaluate in blocks of at most this many
+	                  events to bound the memory use
 	"""
+	if chunksize is not None:
+		tables = response_tables(kind)
+		return chunked(lambda e, m, c: uncorrelated_passing_rate_block(e, m, c, kind, tables),
+		               chunksize, enu, emu, cos_theta)
 	# get contributions to the differential neutrino flux from chunks of
 	# the cosmic ray spectrum in each element
 	contrib, muyield = response_function(enu, emu, cos_theta, kind)[:2]
@@ -312,7 +410,7 @@ def analytic_numu_flux(enu, cos_theta, emu=None):
 	CS = effective_costheta(cos_theta)
 	return (A_PI / ( 1. + B_PI*CS*enu/EPS_PI ) + 0.635 * A_K / ( 1. + B_K*CS*enu/EPS_K ))
 
-def correlated_passing_rate(enu, emu, cos_theta):
+def correlated_passing_rate(enu, emu, cos_theta, chunksize=None):
 	"""
 	Calculate the probability that muon neutrinos of the given energy will be
 	accompanied by a muon from the same decay vertex.
@@ -320,7 +418,11 @@ def correlated_passing_rate(enu, emu, cos_theta):
 	:param enu:       neutrino energy
 	:param emu:       minimum muon energy needed for veto [GeV at surface]
 	:param cos_theta: cosine of zenith angle
+	:param chunksize: if not None, evaluate in blocks of at most this many
+	                  events to bound the memory use
 	"""
+	if chunksize is not None:
+		return chunked(correlated_passing_rate, chunksize, enu, emu, cos_theta)
 	flux = analytic_numu_flux(enu, cos_theta, None)
 	sflux = analytic_numu_flux(enu, cos_theta, emu)
 	return (flux-sflux)/flux
@@ -0,0 +1,99 @@
+"""Elementwise kernels of the integrand hot loops
+
+Each kernel has a NumPy implementation and an explicit loop implementation
+with the same results up to rounding. The loop implementations are compiled
+with Numba when it is installed, otherwise the NumPy ones are used. Numba is
+only imported on the first call of a kernel, and its compiled kernels are
+cached under $NUMBA_CACHE_DIR (defaults to $NUVETO_CACHE/numba or
+~/.nuVeto/numba). Setting $NUVETO_NUMBA=0 forces the NumPy ones.
+"""
+
+import os
+import numpy as np
+
+
+def load_numba():
+    """Returns the numba module, or None if it is not installed or disabled"""
+    if os.environ.get('NUVETO_NUMBA', '1') == '0':
+        return None
+    os.environ.setdefault('NUMBA_CACHE_DIR', os.path.join(
+        os.environ.get('NUVETO_CACHE', os.path.join(os.path.expanduser('~'), '.nuVeto')), 'numba'))
+    try:
+        import numba
+    except ImportError:
+        return None
+    return numba
+
+
+class Kernel(object):
+    """Calls the Numba or the NumPy implementation, picked on the first call"""
+    def __init__(self, numpy, jit):
+        """
+        Args:
+            numpy (function): the NumPy implementation
+            jit (function): returns the compiled implementation from the numba module
+        """
+        self.numpy = numpy
+        self.jit = jit
+        self.impl = None
+
+
+    def __call__(self, *args):
+        if self.impl is None:
+            module = load_numba()
+            self.impl = self.numpy if module is None else self.jit(module)
+        return self.impl(*args)
+
+
+def projectiles_numpy(res, int_yields, prim_flux, prim_xs, ndens):
+    """res[x,i] += sum_j int_yields[i,j]*prim_flux[x,j]*prim_xs[j]*ndens[x]"""
+    res += np.sum(int_yields[None,:,:]*prim_flux[:,None,:]*prim_xs[None,None,:]*ndens[:,None,None], axis=2)
+
+
+def projectiles_loops(res, int_yields, prim_flux, prim_xs, ndens):
+    for x in range(prim_flux.shape[0]):
+        for i in range(int_yields.shape[0]):
+            acc = 0.
+            for j in range(int_yields.shape[1]):
+                acc += int_yields[i, j]*prim_flux[x, j]*prim_xs[j]*ndens[x]
+            res[x, i] += acc
+
+
+def reaching_numpy(pmu, pdet):
+    """1-sum(pmu*pdet, axis=0), clipped at 0"""
+    reaching = 1-np.sum(pmu*pdet, axis=0)
+    reaching[reaching < 0.] = 0.
+    return reaching
+
+
+def reaching_loops(pmu, pdet):
+    reaching = np.ones(pmu.shape[1])
+    for i in range(pmu.shape[0]):
+        for j in range(pmu.shape[1]):
+            reaching[j] -= pmu[i, j]*pdet[i, j]
+    for j in range(pmu.shape[1]):
+        if reaching[j] < 0.:
+            reaching[j] = 0.
+    return reaching
+
+
+def elbert_numpy(x, norm, inv_en, p1, p2, p3, differential):
+    """Elbert yield at x = E/E_N, norm*x^-p1*(1-x^p3)^p2 or its derivative"""
+    icdf = np.where(x >= 1, 0., norm*x**(-p1)*(1-x**p3)**p2)
+    if differential:
+        icdf *= inv_en*np.where(x >= 1, 0., (p1/x + p2*p3*x**(p3-1)/(1-x**p3)))
+    return icdf
+
+
+def elbert_scalar(x, norm, inv_en, p1, p2, p3, differential):
+    if x >= 1:
+        return 0.
+    icdf = norm*x**(-p1)*(1-x**p3)**p2
+    if differential:
+        icdf *= inv_en*(p1/x + p2*p3*x**(p3-1)/(1-x**p3))
+    return icdf
+
+
+projectiles = Kernel(projectiles_numpy, lambda numba: numba.njit(cache=True)(projectiles_loops))
+reaching = Kernel(reaching_numpy, lambda numba: numba.njit(cache=True)(reaching_loops))
+elbert = Kernel(elbert_numpy, lambda numba: numba.vectorize(cache=True)(elbert_scalar))
@@ -7,31 +7,35 @@ given depth.
 
 """
 
+import os
+import hashlib
+import inspect
+import threading
+import time
+from contextlib import contextmanager
+from multiprocessing import Pool
 from functools32 import lru_cache
-from pkg_resources import resource_filename
 import numpy as np
 import scipy.integrate as integrate
 import scipy.interpolate as interpolate
-import MCEq.core
-import MCEq.kernels
-import MCEq.density_profiles
-import MCEq.data
-
-from MCEq.core import MCEqRun
-try:
-    import CRFluxModels.CRFluxModels as pm
-except ImportError:
-    import CRFluxModels as pm
-from mceq_config import config, mceq_config_without
-from nuVeto.utils import Units, ParticleProperties, MuonProb, Geometry, amu, centers
+from nuVeto.utils import Units, ParticleProperties, MuonProb, DecayKernel, Geometry, LazyModule, amu, centers, mceq_config
+from nuVeto.store import md5sum, canonical, version
 from nuVeto.uncertainties import BARR, barr_unc
+from nuVeto import kernels, datafile
+
+# MCEq and the CR flux models are only imported once a nuVeto object is built
+pm = LazyModule('CRFluxModels.CRFluxModels', 'CRFluxModels')
+# directory of grid solutions published with nuVeto.publish that new nuVeto objects attach to
+SOLUTIONS = os.environ.get('NUVETO_SOLUTIONS')
+# the pilot run of adaptive depth grids has 2**DEPTH_LEVELS log-spaced cells
+DEPTH_LEVELS = 7
 
 class nuVeto(object):
     """Class for computing the neutrino passing fraction i.e. (1-(Veto probability))"""
     def __init__(self, costh,
-                 pmodel=(pm.HillasGaisser2012, 'H3a'),
+                 pmodel=('HillasGaisser2012', 'H3a'),
                  hadr='SIBYLL2.3c', barr_mods=(), depth=1950*Units.m,
-                 density=('CORSIKA', ('SouthPole', 'June'))):
+                 density=('CORSIKA', ('SouthPole', 'June')), xtol=None):
         """Initializes the nuVeto object for a particular costheta, CR Flux,
         hadronic model, barr parameters, and depth
 
@@ -41,11 +45,26 @@ class nuVeto(object):
             use mceq.pm_params and mceq.yields_params
         Args:
             costh (float): Cos(theta), the cosine of the neutrino zenith at the detector
-            pmodel (tuple(CR model class, arguments)): CR Flux
+            pmodel (tuple(CR model class, arguments)): CR Flux, the class can also be given by its name
             hadr (str): hadronic interaction model
             barr_mods: barr parameters
             depth (float): the depth at which the veto probability is computed below the ice
+            xtol (float): if given, the slant depth grid of each mother class
+            is adapted to this relative tolerance of the decay integral, see
+            adapt_depths. Otherwise all mothers share 11 log-spaced depths
         """
+        import MCEq.core
+        import MCEq.kernels
+        import MCEq.density_profiles
+        import MCEq.data
+        if isinstance(pmodel[0], str):
+            pmodel = (getattr(pm, pmodel[0]),)+tuple(pmodel[1:])
+        self.args = (costh, pmodel, hadr, barr_mods, depth, density)
+        if xtol is not None:
+            self.args += (xtol,)
+        # guards the MCEq state in solve
+        self.lock = threading.RLock()
+        self.solutions = SOLUTIONS
         self.costh = costh
         self.pmodel = pmodel
         self.geom = Geometry(depth)
@@ -55,7 +74,7 @@ class nuVeto(object):
         MCEq.kernels.dbg = 0
         MCEq.density_profiles.dbg = 0
         MCEq.data.dbg = 0
-        self.mceq = MCEqRun(
+        self.mceq = MCEq.core.MCEqRun(
             # provide the string of the interaction model
             interaction_model=hadr,
             # atmospheric density model
@@ -66,7 +85,7 @@ class nuVeto(object):
             # zenith angle \theta in degrees, measured positively from vertical direction
             theta_deg=theta,
             enable_muon_energy_loss=False,
-            **mceq_config_without(['enable_muon_energy_loss', 'density_model']))
+            **mceq_config.mceq_config_without(['enable_muon_energy_loss', 'density_model']))
 
         for barr_mod in barr_mods:
             # Modify proton-air -> mod[0]
@@ -78,6 +97,66 @@ class nuVeto(object):
                             np.log10(self.mceq.density_model.max_X), 12)
         self.dX_vec = np.diff(X_vec)
         self.X_vec = 10**centers(np.log10(X_vec))
+        # index in X_vec of the depth of the muon flux at the surface
+        self.surface = len(self.X_vec)-1
+        # {mother class: (indices in X_vec, widths)}, all mothers use X_vec and dX_vec if empty
+        self.X_grids = {}
+        if xtol is not None:
+            self.adapt_depths(xtol)
+
+
+    @staticmethod
+    def mother_class(mother):
+        """Charge conjugate mothers share a depth grid"""
+        return mother.replace('-bar', '').rstrip('+-')
+
+
+    def adapt_depths(self, xtol, levels=DEPTH_LEVELS):
+        """Chooses the slant depth grid of each mother class
+
+        The integrand of the decay integral over X, the mother flux of the CR
+        model over its decay length, is tabulated by a pilot run on 2**levels
+        log-spaced cells. Starting from the whole atmosphere, cells are halved
+        while the midpoint rule of get_rescale_phi on them deviates from the
+        pilot integral by more than their share of xtol at any energy, so
+        long-lived mothers at large zenith get finer grids than prompt ones
+        that decay at production. MCEq outputs the union of the grid centers
+        and the surface depth of the default grid.
+        """
+        surface = self.X_vec[self.surface]
+        ncells = 2**levels
+        # even points are the pilot cell edges, odd points their centers
+        points = np.logspace(np.log10(2e-3), np.log10(self.mceq.density_model.max_X), 2*ncells+1)
+        self.X_vec = points
+        grid_sol = self.solve()
+        mothers = set(mother for daughter in DAUGHTERS for mother in self.categ_to_mothers('total', daughter))
+        edges = {}
+        for mother in mothers:
+            integrand = self.inv_decay_length(mother)*self.get_solution(mother, grid_sol, grid_idx=False).T
+            cum = np.zeros((len(self.mceq.e_grid), ncells+1))
+            cum[:,1:] = np.cumsum(np.diff(points[::2])*integrand[:,1::2], axis=1)
+            valid = cum[:,-1] > 0
+            cells = []
+            todo = [(0, ncells)]
+            while todo:
+                lo, hi = todo.pop()
+                midpoint = (points[2*hi]-points[2*lo])*integrand[valid,lo+hi]
+                err = np.abs(midpoint-(cum[valid,hi]-cum[valid,lo]))/cum[valid,-1]
+                if hi-lo > 1 and np.any(err > xtol*(hi-lo)/ncells):
+                    todo.extend([(lo, (lo+hi)//2), ((lo+hi)//2, hi)])
+                else:
+                    cells.extend([lo, hi])
+            # the common refinement of the mothers of a class
+            edges.setdefault(self.mother_class(mother), set()).update(cells)
+        grids = {}
+        for mclass, cells in edges.items():
+            cells = np.array(sorted(cells))
+            grids[mclass] = (cells[:-1]+cells[1:], np.diff(points[2*cells]))
+        idx = np.unique(np.concatenate([mids for mids, widths in grids.values()]))
+        self.surface = np.searchsorted(points[idx], surface)
+        self.X_vec = np.insert(points[idx], self.surface, surface)
+        self.X_grids = dict((mclass, (np.searchsorted(self.X_vec, points[mids]), widths))
+                            for mclass, (mids, widths) in grids.items())
 
 
     @staticmethod
@@ -113,38 +192,55 @@ class nuVeto(object):
         """
         # TODO: replace 1e8 with MMC-prpl interpolated bounds
         return np.logspace(np.log10(enu),
-                           np.log10(enu+1e8), 1000*accuracy)
+                           np.log10(enu+1e8), int(round(1000*accuracy)))
+
+
+    @staticmethod
+    @lru_cache(2**6)
+    def esamp_weights(enu, accuracy):
+        """ returns the trapezoidal weights of the integral over esamp
+        """
+        esamp = nuVeto.esamp(enu, accuracy)
+        weights = np.zeros(len(esamp))
+        weights[1:] += np.diff(esamp)/2
+        weights[:-1] += np.diff(esamp)/2
+        return weights
+
+
+    @staticmethod
+    def ecrs(particle, accuracy):
+        """ returns the sampling of the CR energies of a primary
+        """
+        return amu(particle)*np.logspace(2, 10, int(round(10*accuracy)))
 
 
     @staticmethod
     def projectiles():
         """Get allowed pimaries"""
-        pdg_ids = config['adv_set']['allowed_projectiles']
-        namer = ParticleProperties.modtab.pdg2modname
+        pdg_ids = mceq_config.config['adv_set']['allowed_projectiles']
+        namer = ParticleProperties.pdg2modname
         allowed = []
         for pdg_id in pdg_ids:
-            allowed.append(namer[pdg_id])
+            allowed.append(namer(pdg_id))
             try:
-                allowed.append(namer[-pdg_id])
+                allowed.append(namer(-pdg_id))
             except KeyError:
                 continue
         return allowed
 
 
     @staticmethod
-    def nbody(fpath, esamp, enu, fn, l_ice):
-        with np.load(fpath) as dfile:
-            xmus = centers(dfile['xedges'])
-            xnus = np.concatenate([xmus, [1]])
-            vals = np.nan_to_num(dfile['histograms'])
+    def nbody(name, esamp, enu, fn, l_ice):
+        dfile = datafile.load(name)
+        xmus = centers(dfile['xedges'])
+        xnus = np.concatenate([xmus, [1]])
+        vals = np.nan_to_num(dfile['histograms'])
 
-            ddec = interpolate.RegularGridInterpolator((xnus, xmus), vals,
-                                                       bounds_error=False, fill_value=None)
-            emu_mat = xmus[:,None]*esamp[None,:]*Units.GeV
-            pmu_mat = ddec(np.stack(np.meshgrid(enu/esamp, xmus), axis=-1))
-            reaching = 1-np.sum(pmu_mat*fn.prpl(np.stack([emu_mat, np.ones(emu_mat.shape)*l_ice], axis=-1)), axis=0)
-            reaching[reaching < 0.] = 0.
-            return reaching
+        ddec = interpolate.RegularGridInterpolator((xnus, xmus), vals,
+                                                   bounds_error=False, fill_value=None)
+        emu_mat = xmus[:,None]*esamp[None,:]*Units.GeV
+        pmu_mat = ddec(np.stack(np.meshgrid(enu/esamp, xmus), axis=-1))
+        return kernels.reaching(pmu_mat, fn.prpl(np.stack([emu_mat, np.ones(emu_mat.shape)*l_ice], axis=-1)))
 
 
     @staticmethod
@@ -155,25 +251,17 @@ class nuVeto(object):
         esamp = nuVeto.esamp(enu, accuracy)
         fn = MuonProb(prpl)
         if mother in ['D0', 'D0-bar']:
-            reaching = nuVeto.nbody(
-                resource_filename(
-                'nuVeto','data/decay_distributions/D0_numu.npz'),
-                esamp, enu, fn, l_ice)
+            reaching = nuVeto.nbody('decay_distributions/D0_numu',
+                                    esamp, enu, fn, l_ice)
         elif mother in ['D+', 'D-']:
-            reaching = nuVeto.nbody(
-                resource_filename(
-                'nuVeto','data/decay_distributions/D+_numu.npz'),
-                esamp, enu, fn, l_ice)
+            reaching = nuVeto.nbody('decay_distributions/D+_numu',
+                                    esamp, enu, fn, l_ice)
         elif mother in ['Ds+', 'Ds-']:
-            reaching = nuVeto.nbody(
-                resource_filename(
-                'nuVeto','data/decay_distributions/Ds_numu.npz'),
-                esamp, enu, fn, l_ice)
+            reaching = nuVeto.nbody('decay_distributions/Ds_numu',
+                                    esamp, enu, fn, l_ice)
         elif mother == 'K0L':
-            reaching = nuVeto.nbody(
-                resource_filename(
-                'nuVeto','data/decay_distributions/K0L_numu.npz'),
-                esamp, enu, fn, l_ice)
+            reaching = nuVeto.nbody('decay_distributions/K0L_numu',
+                                    esamp, enu, fn, l_ice)
         else:
             # Assuming muon energy is E_parent - E_nu
             reaching = 1. - fn.prpl(zip((esamp-enu)*Units.GeV,
@@ -184,45 +272,71 @@ class nuVeto(object):
     @lru_cache(maxsize=2**12)
     def get_dNdEE(self, mother, daughter):
         """Differential parent-->neutrino (mother--daughter) yield"""
-        ihijo = 20
-        e_grid = self.mceq.e_grid
-        delta = self.mceq.e_widths
-        x_range = e_grid[ihijo]/e_grid
-        rr = ParticleProperties.rr(mother, daughter)
-        dNdEE_edge = ParticleProperties.br_2body(mother, daughter)/(1-rr)
-        dN_mat = self.mceq.decays.get_d_matrix(
-            ParticleProperties.pdg_id[mother],
-            ParticleProperties.pdg_id[daughter])
-        dNdEE = dN_mat[ihijo]*e_grid/delta
-        logx = np.log10(x_range)
-        logx_width = -np.diff(logx)[0]
-        good = (logx + logx_width/2 < np.log10(1-rr)) & (x_range >= 5.e-2)
-
-        x_low = x_range[x_range < 5e-2]
-        dNdEE_low = np.array([dNdEE[good][-1]]*x_low.size)
-        dNdEE_interp = lambda x_: interpolate.pchip(
-            np.concatenate([[1-rr], x_range[good], x_low])[::-1],
-            np.concatenate([[dNdEE_edge], dNdEE[good], dNdEE_low])[::-1],
-            extrapolate=True)(x_) * np.heaviside(1-rr-x_, 1)
-        return x_range, dNdEE, dNdEE_interp
+        kernel = decay_kernels(self.mceq, (mother, daughter))[mother, daughter]
+        return kernel.x_range, kernel.dNdEE, kernel
 
 
     @lru_cache(maxsize=2**12)
     def grid_sol(self, ecr=None, particle=None):
         """MCEq grid solution for \\frac{dN_{CR,p}}_{dE_p}"""
-        if ecr is not None:
-            self.mceq.set_single_primary_particle(ecr, particle)
-        else:
-            self.mceq.set_primary_model(*self.pmodel)
-        self.mceq.solve(int_grid=self.X_vec, grid_var="X")
-        return self.mceq.grid_sol
+        fpath = self.solution_path(ecr, particle)
+        if fpath is not None and os.path.isfile(fpath):
+            # published by publish, shared read-only between processes
+            return np.load(fpath, mmap_mode='r')
+        return self.solve(ecr, particle)
+
+
+    def solve(self, ecr=None, particle=None):
+        """Runs MCEq for a single primary or the CR model if ecr is None"""
+        with self.lock:
+            if ecr is not None:
+                self.mceq.set_single_primary_particle(ecr, particle)
+            else:
+                self.mceq.set_primary_model(*self.pmodel)
+            self.mceq.solve(int_grid=self.X_vec, grid_var="X")
+            return self.mceq.grid_sol
+
+
+    def solution_path(self, ecr=None, particle=None):
+        """File of the published grid solution, None if not attached"""
+        if self.solutions is None:
+            return None
+        name = hashlib.sha1('{}|{}'.format(version(), canonical(self.args+(ecr, particle))).encode())
+        return os.path.join(self.solutions, name.hexdigest()+'.npy')
+
+
+    def publish(self, path, accuracy=3.5):
+        """Writes the grid solutions needed by get_fluxes to path and attaches to them
+
+        nuVeto objects with the same arguments attach to them with
+        attach(path) or $NUVETO_SOLUTIONS and memory-map them read-only
+        instead of solving, sharing one copy between processes.
+        """
+        self.attach(path)
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        pmodel = self.pmodel[0](self.pmodel[1])
+        points = [(None, None)]
+        for particle in pmodel.nucleus_ids:
+            points.extend((ecr, particle) for ecr in self.ecrs(particle, accuracy))
+        for ecr, particle in points:
+            fpath = self.solution_path(ecr, particle)
+            if not os.path.isfile(fpath):
+                with datafile.atomic(fpath) as f:
+                    np.save(f, np.asarray(self.solve(ecr, particle)))
+
+
+    def attach(self, path):
+        """Uses the grid solutions published to path"""
+        self.solutions = path
 
 
     @lru_cache(maxsize=2**12)
-    def nmu(self, ecr, particle, prpl='ice_allm97_step_1'):
+    def nmu(self, ecr, particle, prpl='ice_allm97_step_1', l_ice=None):
         """Poisson probability of getting no muons"""
         grid_sol = self.grid_sol(ecr, particle)
-        l_ice = self.geom.overburden(self.costh)
+        if l_ice is None:
+            l_ice = self.geom.overburden(self.costh)
         mu = self.get_solution('mu-', grid_sol) + self.get_solution('mu+', grid_sol)
 
         fn = MuonProb(prpl)
@@ -230,56 +344,148 @@ class nuVeto(object):
         return np.trapz(mu*fn.prpl(coords), self.mceq.e_grid)
 
 
+    def inv_decay_length(self, mother):
+        """Inverse decay length of the mother in X on (e_grid, X_vec)"""
+        rho = self.mceq.density_model.X2rho(self.X_vec)*Units.gr/Units.cm**3
+        return (ParticleProperties.mass_dict[mother] / (self.mceq.e_grid[:,None] * Units.GeV)) / (ParticleProperties.lifetime_dict[mother]*rho[None,:])
+
+
     @lru_cache(maxsize=2**12)
     def get_rescale_phi(self, mother, ecr=None, particle=None):
-        """Flux of the mother at all heights"""
+        """Flux of the mother at all heights
+
+        With adapted depth grids the depths outside of the grid of the mother
+        class are zero.
+        """
         grid_sol = self.grid_sol(ecr, particle) # MCEq solution (fluxes tabulated as a function of height)
         dX = self.dX_vec*Units.gr/Units.cm**2
-        rho = self.mceq.density_model.X2rho(self.X_vec)*Units.gr/Units.cm**3
-        inv_decay_length_array = (ParticleProperties.mass_dict[mother] / (self.mceq.e_grid[:,None] * Units.GeV)) / (ParticleProperties.lifetime_dict[mother]*rho[None,:])
-        rescale_phi = dX[None,:]* inv_decay_length_array * self.get_solution(mother, grid_sol, grid_idx=False).T
+        if self.X_grids:
+            if self.mother_class(mother) not in self.X_grids:
+                raise ValueError('No depth grid for {}'.format(mother))
+            cols, widths = self.X_grids[self.mother_class(mother)]
+            dX = np.zeros(len(self.X_vec))
+            dX[cols] = widths*Units.gr/Units.cm**2
+        rescale_phi = dX[None,:]* self.inv_decay_length(mother) * self.get_solution(mother, grid_sol, grid_idx=False).T
         return rescale_phi
 
 
-    def get_integrand(self, categ, daughter, enu, accuracy, prpl, ecr=None, particle=None):
-        """flux*yield"""
+    def sample_phi(self, mother, esamp, ecr=None, particle=None):
+        """get_rescale_phi interpolated onto esamp and summed over X
+
+        The depths with the same positive grid points are interpolated
+        together, which forms an (esamp, depths) array per group. One
+        interpolation per depth avoids it but makes get_fluxes about 3x slower.
+        """
+        rescale_phi = self.get_rescale_phi(mother, ecr, particle)
+        groups = {}
+        for i in xrange(rescale_phi.shape[1]):
+            groups.setdefault((rescale_phi[:,i]>0).tobytes(), []).append(i)
+        sampled = np.zeros(len(esamp))
+        for cols in groups.values():
+            pos = rescale_phi[:,cols[0]]>0
+            if not np.any(pos):
+                continue
+            sampled += np.sum(np.exp(interpolate.interp1d(
+                np.log(self.mceq.e_grid[pos]),
+                np.log(rescale_phi[pos][:,cols]), axis=0,
+                kind='quadratic', bounds_error=False, fill_value=-np.inf)(np.log(esamp))), axis=1)
+        return sampled
+
+
+    @lru_cache(maxsize=2**12)
+    def yield_weights(self, mother, daughter, enu, accuracy, prpl, l_ice):
+        """dN/dE of the daughter on esamp times the weights of the esamp integral
+
+        Returns:
+            (den, num), num is suppressed by the sibling muon
+        """
         esamp = self.esamp(enu, accuracy)
-        mothers = self.categ_to_mothers(categ, daughter)
-        nums = np.zeros((len(esamp),len(self.X_vec)))
-        dens = np.zeros((len(esamp),len(self.X_vec)))
-        for mother in mothers:
-            dNdEE = self.get_dNdEE(mother, daughter)[-1]
-            rescale_phi = self.get_rescale_phi(mother, ecr, particle)
-            # DEBUG
-            # from matplotlib import pyplot as plt
-            # plt.plot(np.log(self.mceq.e_grid[rescale_phi[:,0]>0]),
-            #          np.log(rescale_phi[:,0][rescale_phi[:,0]>0]))
-            # rescale_phi = np.array([interpolate.interp1d(self.mceq.e_grid, rescale_phi[:,i], kind='quadratic', bounds_error=False, fill_value=0)(esamp) for i in xrange(rescale_phi.shape[1])]).T
-            ###
-            # TODO: optimize to only run when esamp[0] is non-zero
-            rescale_phi = np.exp(np.array([interpolate.interp1d(
-                np.log(self.mceq.e_grid[rescale_phi[:,i]>0]),
-                np.log(rescale_phi[:,i][rescale_phi[:,i]>0]),
-                kind='quadratic', bounds_error=False, fill_value=-np.inf)(np.log(esamp)) for i in xrange(rescale_phi.shape[1])])).T
-            # DEBUG
-            # print rescale_phi.min(), rescale_phi.max()
-            # print np.log(esamp)
-            # plt.plot(np.log(esamp),
-            #          np.log(rescale_phi[:,0]), label='intp')
-            # plt.legend()
-            # import pdb
-            # pdb.set_trace()
-            ###
-            if 'numu' in daughter:
-                # muon accompanies numu only
-                pnmsib = self.psib(self.geom.overburden(self.costh),
-                                   mother, enu, accuracy, prpl)
+        den = self.esamp_weights(enu, accuracy)*self.get_dNdEE(mother, daughter)[-1](enu/esamp)/esamp
+        if 'numu' in daughter:
+            # muon accompanies numu only
+            return den, den*self.psib(l_ice, mother, enu, accuracy, prpl)
+        return den, den
+
+
+    def get_reduced(self, categ, daughter, enu, accuracy, prpls, pnmarrs=None, ecr=None, particle=None, l_ice=None, phis=None):
+        """flux*yield integrated over X and esamp
+
+        The mother fluxes are summed over X once and contracted with
+        yield_weights, so the (esamp, X) integrands are never formed. The
+        X-summed mother fluxes are reused from and added to the dict phis if
+        given.
+
+        Args:
+            pnmarrs: the probabilities of no other muon on esamp for each of
+            prpls, ones if None
+        Returns:
+            (nums, den), nums for each of prpls
+        """
+        if l_ice is None:
+            l_ice = self.geom.overburden(self.costh)
+        esamp = self.esamp(enu, accuracy)
+        nums = np.zeros(len(prpls))
+        den = 0.
+        for mother in self.categ_to_mothers(categ, daughter):
+            if phis is not None and mother in phis:
+                phi = phis[mother]
             else:
-                pnmsib = np.ones(len(esamp))            
-            dnde = dNdEE(enu/esamp)/esamp
-            nums += (dnde * pnmsib)[:,None]*rescale_phi
-            dens += (dnde)[:,None]*rescale_phi
+                phi = self.sample_phi(mother, esamp, ecr, particle)
+                if phis is not None:
+                    phis[mother] = phi
+            den += np.dot(self.yield_weights(mother, daughter, enu, accuracy, prpls[0], l_ice)[0], phi)
+            for iprpl, prpl in enumerate(prpls):
+                num = self.yield_weights(mother, daughter, enu, accuracy, prpl, l_ice)[1]
+                if pnmarrs is None:
+                    nums[iprpl] += np.dot(num, phi)
+                else:
+                    nums[iprpl] += np.einsum('i,i,i->', num, pnmarrs[iprpl], phi)
+        return nums, den
+
+
+    @lru_cache(maxsize=2**2)
+    def interpolation_matrix(self, enu, accuracy):
+        """Linear map from e_grid to esamp
+
+        The mother fluxes fall roughly as E^-3, they are interpolated
+        quadratically in log(E) after flattening by E^3. The matrix is dense,
+        len(esamp) x len(e_grid), so only the last few enus are cached.
+        """
+        esamp = self.esamp(enu, accuracy)
+        e_grid = self.mceq.e_grid
+        return interpolate.interp1d(np.log(e_grid), np.diag(e_grid**3), kind='quadratic', axis=0,
+                                    bounds_error=False, fill_value=0.)(np.log(esamp))/esamp[:,None]**3
+
 
+    def get_convolved(self, categ, daughter, enu, accuracy, prpls, ecr=None, particle=None, l_ice=None, phis=None):
+        """flux*yield from the interpolation matrix
+
+        The X-summed mother fluxes are mapped onto esamp with
+        interpolation_matrix and weighted with yield_weights. Returns the
+        integrands on esamp, nums for each of prpls. The mother fluxes on esamp
+        are reused from and added to the dict phis if given.
+        """
+        if l_ice is None:
+            l_ice = self.geom.overburden(self.costh)
+        esamp = self.esamp(enu, accuracy)
+        nums = np.zeros((len(prpls), len(esamp)))
+        dens = np.zeros(len(esamp))
+        for mother in self.categ_to_mothers(categ, daughter):
+            if phis is not None and mother in phis:
+                phi = phis[mother]
+            else:
+                phi = np.sum(self.get_rescale_phi(mother, ecr, particle), axis=1)
+                # the flux vanishes outside of the positive grid points
+                support = np.zeros(len(esamp), dtype=bool)
+                if np.any(phi > 0):
+                    e_pos = self.mceq.e_grid[phi > 0]
+                    support = (esamp >= e_pos[0]) & (esamp <= e_pos[-1])
+                phi = self.interpolation_matrix(enu, accuracy).dot(phi)*support
+                if phis is not None:
+                    phis[mother] = phi
+            for num, prpl in zip(nums, prpls):
+                num += self.yield_weights(mother, daughter, enu, accuracy, prpl, l_ice)[1]*phi
+            dens += self.yield_weights(mother, daughter, enu, accuracy, prpls[0], l_ice)[0]*phi
         return nums, dens
 
 
@@ -313,15 +519,15 @@ class nuVeto(object):
         reduce_res = True
 
         if grid_idx is None: # Surface only case
-            sol = np.array([grid_sol[-1]])
-            xv = np.array([self.X_vec[-1]])
+            sol = np.array([grid_sol[self.surface]])
+            xv = np.array([self.X_vec[self.surface]])
         elif isinstance(grid_idx, bool) and not grid_idx: # Whole solution case
             sol = np.asarray(grid_sol)
             xv = np.asarray(self.X_vec)
             reduce_res = False
         elif grid_idx >= len(self.mceq.grid_sol): # Surface only case
-            sol = np.array([grid_sol[-1]])
-            xv = np.array([self.X_vec[-1]])
+            sol = np.array([grid_sol[self.surface]])
+            xv = np.array([self.X_vec[self.surface]])
         else: # Particular height case
             sol = np.array([grid_sol[grid_idx]])
             xv = np.array([self.X_vec[grid_idx]])
@@ -348,7 +554,7 @@ class nuVeto(object):
                 int_yields = self.mceq.y.get_y_matrix(
                     ParticleProperties.pdg_id[prim],
                     p_pdg)
-                res += np.sum(int_yields[None,:,:]*prim_flux[:,None,:]*prim_xs[None,None,:]*ndens[:,None,None], axis=2)
+                kernels.projectiles(res, int_yields, prim_flux, prim_xs, ndens)
             except KeyError as e:
                 continue
 
@@ -368,28 +574,56 @@ class nuVeto(object):
         return res
 
 
-    def get_fluxes(self, enu, kind='conv_numu', accuracy=3.5, prpl='ice_allm97_step_1', corr_only=False):
+    def get_fluxes(self, enu, kind='conv_numu', accuracy=3.5, prpl='ice_allm97_step_1', corr_only=False, l_ice=None, rtol=None, matrices=False, auto_rtol=1e-3):
         """Returns the flux and passing fraction
         for a particular neutrino energy, flux, and p_light
+
+        Args:
+            kind: a kind or a sequence of them, in which case a dict of the
+            results of each kind is returned from one pass over E_CR. total_
+            kinds are the sum of the conv_ and pr_ ones
+            prpl: a prpl model or a sequence of them, in which case a list of
+            (passed, total) is returned sharing all the prpl independent terms
+            l_ice (float): overburden in m, defaults to the one of self.geom
+            rtol (float): if given, the E_CR integral of each primary stops
+            once the remaining contribution, estimated by a geometric
+            extrapolation of the last two E_CR points, is below rtol of the
+            accumulated passed and total fluxes. (result, report) is returned
+            then, report holds rtol, the largest estimated tail and the
+            (evaluated, available) E_CR points of each primary in 'ecrs'
+            matrices (bool): map the mother fluxes on e_grid onto esamp with the
+            cached interpolation_matrix instead of interpolating them at every E_CR.
+            Much faster, the interpolation differs at the flux cutoffs only
+            accuracy: 'auto' evaluates the ACCURACIES in turn until two
+            successive results agree within auto_rtol, each pruned with rtol.
+            (result, report) is returned then, see converge
         """
+        if accuracy == 'auto':
+            return converge(lambda accuracy: self.get_fluxes(enu, kind, accuracy, prpl, corr_only, l_ice, rtol, matrices),
+                            auto_rtol, rtol is not None)
         # prpl = probability of reaching * probability of light
         # prpl -> None ==> median for muon reaching
-        categ, daughter = kind.split('_')
-
-        esamp = self.esamp(enu, accuracy)
+        prpls = list(prpl) if isinstance(prpl, (list, tuple)) else [prpl]
+        base = self._base(kind)
 
+        passed = dict((kind_, np.zeros(len(prpls))) for kind_ in base)
+        total = dict((kind_, 0) for kind_ in base)
+        report = {'rtol':rtol, 'ecrs':{}, 'tail':0.}
         # Correlated only (no need for the unified calculation here) [really just for testing]
-        passed = 0
-        total = 0
         if corr_only:
-            # sum performs the dX integral
-            nums, dens = self.get_integrand(categ, daughter, enu, accuracy, prpl)
-            num = np.sum(nums, axis=1)
-            den = np.sum(dens, axis=1)
-            passed = integrate.trapz(num, esamp)
-            total = integrate.trapz(den, esamp)
-            return passed, total
-                
+            phis = {}
+            for kind_ in base:
+                categ, daughter = kind_.split('_')
+                if matrices:
+                    nums, dens = self.get_convolved(categ, daughter, enu, accuracy, prpls, l_ice=l_ice, phis=phis)
+                    passed[kind_] = np.sum(nums, axis=-1)
+                    total[kind_] = np.sum(dens)
+                    continue
+                passed[kind_], total[kind_] = self.get_reduced(categ, daughter, enu, accuracy, prpls,
+                                                               l_ice=l_ice, phis=phis)
+            res = self._collect(kind, prpl, passed, total)
+            return res if rtol is None else (res, report)
+
         pmodel = self.pmodel[0](self.pmodel[1])
 
         #loop over primary particles
@@ -401,57 +635,505 @@ class nuVeto(object):
             # amu --> atomic mass of primary
 
             # evaluation points in E_CR
-            ecrs = amu(particle)*np.logspace(2, 10, 10*accuracy)
+            ecrs = self.ecrs(particle, accuracy)
 
-            # pnm --> probability of no muon (just a poisson probability)
-            nmu = [self.nmu(ecr, particle, prpl) for ecr in ecrs]
-
-            # nmufn --> fine grid interpolation of pnm
-            nmufn = interpolate.interp1d(ecrs, nmu, kind='linear',
-                                         assume_sorted=True, bounds_error=False,
-                                         fill_value=(0,np.nan))
             # nums --> numerator
-            nums = []
+            nums = dict((kind_, []) for kind_ in base)
             # dens --> denominator
-            dens = []
+            dens = dict((kind_, []) for kind_ in base)
             # istart --> integration starting point, the lowest energy index for the integral
             istart = max(0, np.argmax(ecrs > enu) - 1)
-            for ecr in ecrs[istart:]: # integral in primary energy (E_CR)
-                # cr_flux --> cosmic ray flux
-                # phim2 --> units of flux * m^2 (look it up in the units)
-                cr_flux = pmodel.nucleus_flux(particle, ecr.item())*Units.phim2
-                # poisson exp(-Nmu) [last term in eq 12]
-                pnmarr = np.exp(-nmufn(ecr-esamp))
+            # cr_flux --> cosmic ray flux
+            # phim2 --> units of flux * m^2 (look it up in the units)
+            cr_fluxes = pmodel.nucleus_flux(particle, ecrs[istart:])*Units.phim2
+            responses = self.get_responses(enu, base, accuracy, prpls, particle, ecrs, istart, l_ice, matrices)
+            for iecr, (nums_ecr, dens_ecr) in enumerate(responses, istart): # integral in primary energy (E_CR)
+                cr_flux = cr_fluxes[iecr-istart]
+                for kind_ in base:
+                    num_ecr, den_ecr = nums_ecr[kind_], dens_ecr[kind_]
+                    nums[kind_].append(num_ecr*cr_flux/Units.phicm2)
+                    dens[kind_].append(den_ecr*cr_flux/Units.phicm2)
+
+                # the primaries contribute once their energy per nucleon exceeds enu
+                started = any(den > 0 for kind_ in base for den in dens[kind_])
+                if rtol is not None and iecr > istart and started:
+                    with np.errstate(divide='ignore', invalid='ignore'):
+                        tail = max(np.max(np.nan_to_num(
+                            self.tail(ecrs[iecr-1:iecr+1], vals[kind_][-2:], len(ecrs)-1-iecr)/
+                            integrate.trapz(vals[kind_], ecrs[istart:iecr+1], axis=0)))
+                                   for vals in (nums, dens) for kind_ in base)
+                    if tail < rtol:
+                        report['tail'] = max(report['tail'], tail)
+                        break
+            report['ecrs'][particle] = (len(dens[base[0]]), len(ecrs)-istart)
+            # dEcr
+            for kind_ in base:
+                passed[kind_] += integrate.trapz(nums[kind_], ecrs[istart:istart+len(nums[kind_])], axis=0)
+                total[kind_] += integrate.trapz(dens[kind_], ecrs[istart:istart+len(dens[kind_])])
 
-                num_ecr = 0 # single entry in nums
-                den_ecr = 0 # single entry in dens
+        res = self._collect(kind, prpl, passed, total)
+        return res if rtol is None else (res, report)
 
+
+    def get_responses(self, enu, base, accuracy, prpls, particle, ecrs, istart, l_ice=None, matrices=False):
+        """Yields the (nums, dens) of the kinds in base at each of ecrs[istart:]
+        per unit flux of the primary particle
+
+        nums holds the numerator of each prpl. The E_CR points are evaluated
+        as they are consumed, so stopping early skips the rest.
+        """
+        esamp = self.esamp(enu, accuracy)
+        # pnm --> probability of no muon (just a poisson probability)
+        # evaluated up to the current E_CR, for each prpl
+        nmus = [[] for prpl_ in prpls]
+        for iecr, ecr in enumerate(ecrs[istart:], istart):
+            # nmufn --> fine grid interpolation of pnm, only E_CR below ecr are needed
+            pnmarrs = []
+            for nmu, prpl_ in zip(nmus, prpls):
+                # at least two points for the interpolation
+                nmu.extend(self.nmu(ecr_, particle, prpl_, l_ice) for ecr_ in ecrs[len(nmu):max(iecr+1, 2)])
+                nmufn = interpolate.interp1d(ecrs[:len(nmu)], nmu, kind='linear',
+                                             assume_sorted=True, bounds_error=False,
+                                             fill_value=(0,np.nan))
+                # poisson exp(-Nmu) [last term in eq 12]
+                pnmarrs.append(np.exp(-nmufn(ecr-esamp)))
+            # mother fluxes shared by all kinds
+            phis = {}
+            nums, dens = {}, {}
+            for kind_ in base:
+                categ, daughter = kind_.split('_')
                 # dEp
                 # integral in Ep
-                nums_ecr, dens_ecr = self.get_integrand(categ, daughter, enu, accuracy, prpl, ecr, particle)
-                num_ecr = integrate.trapz(np.sum(nums_ecr, axis=1)*pnmarr, esamp)
-                den_ecr = integrate.trapz(np.sum(dens_ecr, axis=1), esamp)
+                if matrices:
+                    nums_ecr, dens_ecr = self.get_convolved(categ, daughter, enu, accuracy, prpls, ecr, particle, l_ice, phis)
+                    nums[kind_] = np.array([np.sum(num*pnmarr) for num, pnmarr in zip(nums_ecr, pnmarrs)])
+                    dens[kind_] = np.sum(dens_ecr)
+                else:
+                    # single entry in nums, for each prpl, and in dens
+                    nums[kind_], dens[kind_] = self.get_reduced(categ, daughter, enu, accuracy, prpls, pnmarrs,
+                                                                ecr, particle, l_ice, phis)
+            yield nums, dens
 
-                nums.append(num_ecr*cr_flux/Units.phicm2)
-                dens.append(den_ecr*cr_flux/Units.phicm2)
-            # dEcr
-            passed += integrate.trapz(nums, ecrs[istart:])
-            total += integrate.trapz(dens, ecrs[istart:])
 
-        return passed, total
+    def get_response(self, enu, kind='conv_numu', accuracy=3.5, prpl='ice_allm97_step_1', l_ice=None, matrices=False, particles=None):
+        """Returns the Response of get_fluxes to the primary flux
+
+        The passed and total fluxes of the unified calculation are linear in
+        the flux of each primary, the response holds their integrands per
+        unit flux at each E_CR. Response.fluxes integrates them against any
+        CR model without solving MCEq again.
+
+        Args:
+            particles: the corsika ids of the primaries, defaults to the ones
+            of the CR model of self
+        """
+        if particles is None:
+            particles = self.pmodel[0](self.pmodel[1]).nucleus_ids
+        prpls = list(prpl) if isinstance(prpl, (list, tuple)) else [prpl]
+        base = self._base(kind)
+        ecrs, nums, dens = {}, {}, {}
+        for particle in particles:
+            ecrs_ = self.ecrs(particle, accuracy)
+            istart = max(0, np.argmax(ecrs_ > enu) - 1)
+            ecrs[particle] = ecrs_[istart:]
+            res = list(self.get_responses(enu, base, accuracy, prpls, particle, ecrs_, istart, l_ice, matrices))
+            nums[particle] = dict((kind_, np.array([num[kind_] for num, den in res])/Units.phicm2) for kind_ in base)
+            dens[particle] = dict((kind_, np.array([den[kind_] for num, den in res])/Units.phicm2) for kind_ in base)
+        return Response(kind, prpl, ecrs, nums, dens)
+
+
+    @staticmethod
+    def tail(ecrs, vals, n):
+        """Trapezoidal integral over the next n points of the geometric
+        continuation of (ecrs, vals)
+
+        Returns inf unless the continuation falls faster than 1/E_CR.
+        """
+        vals = np.asarray(vals, dtype=float)
+        q = ecrs[1]/ecrs[0]
+        with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+            r = vals[1]/vals[0]
+            tail = ecrs[1]*(q-1)*vals[1]*(1+r)/2*(1-(q*r)**n)/(1-q*r)
+        return np.where(vals[1] == 0, 0, np.where(q*r < 1, tail, np.inf))
+
+
+    @staticmethod
+    def _base(kind):
+        """Kinds that are integrated for a kind or a sequence of them, total
+        is summed from conv and pr
+        """
+        base = []
+        for kind_ in (kind if isinstance(kind, (list, tuple)) else [kind]):
+            categ, daughter = kind_.split('_')
+            for kind_ in (['conv_'+daughter, 'pr_'+daughter] if categ == 'total' else [kind_]):
+                if kind_ not in base:
+                    base.append(kind_)
+        return base
+
+
+    @staticmethod
+    def _collect(kind, prpl, passed, total):
+        """Arranges the integrated fluxes of get_fluxes by kind and prpl"""
+        res = {}
+        for kind_ in (kind if isinstance(kind, (list, tuple)) else [kind]):
+            categ, daughter = kind_.split('_')
+            if categ == 'total':
+                num = passed['conv_'+daughter] + passed['pr_'+daughter]
+                den = total['conv_'+daughter] + total['pr_'+daughter]
+            else:
+                num, den = passed[kind_], total[kind_]
+            res[kind_] = [(num_, den) for num_ in num] if isinstance(prpl, (list, tuple)) else (num[0], den)
+        return res if isinstance(kind, (list, tuple)) else res[kind]
+
+
+class Response(object):
+    """Passed and total flux integrands per unit flux of each primary"""
+    def __init__(self, kind, prpl, ecrs, nums, dens):
+        """
+        Args:
+            ecrs: {particle: E_CR points}
+            nums: {particle: {kind: numerators with shape (E_CR points, prpls)}}
+            dens: {particle: {kind: denominators on the E_CR points}}
+        """
+        self.kind = kind
+        self.prpl = prpl
+        self.ecrs = ecrs
+        self.nums = nums
+        self.dens = dens
+
+
+    def fluxes(self, pmodel):
+        """Returns the result of nuVeto.get_fluxes for the CR model pmodel
+
+        Args:
+            pmodel: a (CR model class or its name, arguments) tuple, a CR
+            model instance or {particle: flux on self.ecrs[particle]} in the
+            units of nucleus_flux
+        """
+        if isinstance(pmodel, tuple):
+            pmodel = (getattr(pm, pmodel[0]) if isinstance(pmodel[0], str) else pmodel[0])(pmodel[1])
+        if isinstance(pmodel, dict):
+            particles = pmodel.keys()
+            cr_fluxes = dict((particle, np.asarray(pmodel[particle])) for particle in particles)
+        else:
+            particles = pmodel.nucleus_ids
+            cr_fluxes = dict((particle, pmodel.nucleus_flux(particle, self.ecrs.get(particle, [])))
+                             for particle in particles)
+        missing = set(particles) - set(self.ecrs)
+        if missing:
+            raise ValueError('No response to the primaries {}'.format(sorted(missing)))
+        base = self.dens[particles[0]].keys()
+        passed = dict((kind_, 0.) for kind_ in base)
+        total = dict((kind_, 0.) for kind_ in base)
+        for particle in particles:
+            cr_flux = cr_fluxes[particle]*Units.phim2
+            for kind_ in base:
+                passed[kind_] = passed[kind_] + integrate.trapz(self.nums[particle][kind_]*cr_flux[:,None],
+                                                                self.ecrs[particle], axis=0)
+                total[kind_] = total[kind_] + integrate.trapz(self.dens[particle][kind_]*cr_flux,
+                                                              self.ecrs[particle])
+        return nuVeto._collect(self.kind, self.prpl, passed, total)
+
+
+    def passing(self, pmodel, fraction=True):
+        """Returns the result of passing for the CR model pmodel, see fluxes"""
+        return to_passing(self.fluxes(pmodel), self.kind, self.prpl, fraction)
+
+
+DAUGHTERS = ['nue', 'antinue', 'numu', 'antinumu', 'nutau', 'antinutau']
+_decay_kernels = {}
+_decay_lock = threading.Lock()
+
+
+def decay_kernel(mceq, mother, daughter):
+    """Builds the dN/dE(x) kernel of a mother-daughter pair from the MCEq decay tables"""
+    ihijo = 20
+    e_grid = mceq.e_grid
+    delta = mceq.e_widths
+    x_range = e_grid[ihijo]/e_grid
+    rr = ParticleProperties.rr(mother, daughter)
+    dNdEE_edge = ParticleProperties.br_2body(mother, daughter)/(1-rr)
+    dN_mat = mceq.decays.get_d_matrix(
+        ParticleProperties.pdg_id[mother],
+        ParticleProperties.pdg_id[daughter])
+    dNdEE = dN_mat[ihijo]*e_grid/delta
+    logx = np.log10(x_range)
+    logx_width = -np.diff(logx)[0]
+    good = (logx + logx_width/2 < np.log10(1-rr)) & (x_range >= 5.e-2)
+
+    x_low = x_range[x_range < 5e-2]
+    dNdEE_low = np.array([dNdEE[good][-1]]*x_low.size)
+    return DecayKernel(x_range, dNdEE,
+                       np.concatenate([[1-rr], x_range[good], x_low])[::-1],
+                       np.concatenate([[dNdEE_edge], dNdEE[good], dNdEE_low])[::-1],
+                       1-rr)
+
+
+def decay_version(e_grid):
+    """Returns the stamp of the MCEq decay tables on e_grid and of the
+    particle snapshot
+    """
+    md5 = hashlib.md5(np.asarray(e_grid, dtype=float).tobytes())
+    md5.update(md5sum(datafile.locate('particles')).encode())
+    fname = mceq_config.config.get('decay_fname', '')
+    md5.update(fname.encode())
+    fpath = os.path.join(mceq_config.config.get('data_dir') or '', fname)
+    if os.path.isfile(fpath):
+        md5.update(md5sum(fpath).encode())
+    return md5.hexdigest()[:12]
+
+
+def decay_kernels(mceq, pair=None):
+    """Returns the dN/dE(x) kernels of every mother-daughter pair in
+    categ_to_mothers, shared by all nuVeto objects
+
+    The kernels are built once per version of the MCEq decay tables and
+    serialized to $NUVETO_CACHE (defaults to ~/.nuVeto). pair is added to the
+    table if it is not part of it.
+    """
+    version = decay_version(mceq.e_grid)
+    with _decay_lock:
+        if version not in _decay_kernels:
+            fpath = os.path.join(os.environ.get('NUVETO_CACHE', os.path.join(os.path.expanduser('~'), '.nuVeto')),
+                                 'decay_kernels_{}.npz'.format(version))
+            try:
+                with np.load(fpath) as dfile:
+                    kernels = dict(
+                        (tuple(name.split('|')), DecayKernel(*[dfile[name+'|'+field] for field in
+                                                               ('x_range', 'dNdEE', 'x_knots', 'dNdEE_knots', 'x_max')]))
+                        for name in set(k.rsplit('|', 1)[0] for k in dfile.files))
+            except IOError:
+                kernels = dict(((mother, daughter), decay_kernel(mceq, mother, daughter))
+                               for daughter in DAUGHTERS
+                               for mother in nuVeto.categ_to_mothers('total', daughter))
+                arrays = {}
+                for (mother, daughter), kernel in kernels.items():
+                    for field in ('x_range', 'dNdEE', 'x_knots', 'dNdEE_knots', 'x_max'):
+                        arrays['{}|{}|{}'.format(mother, daughter, field)] = getattr(kernel, field)
+                try:
+                    if not os.path.isdir(os.path.dirname(fpath)):
+                        os.makedirs(os.path.dirname(fpath))
+                    with datafile.atomic(fpath) as f:
+                        np.savez(f, **arrays)
+                except (IOError, OSError):
+                    pass
+            _decay_kernels[version] = kernels
+        kernels = _decay_kernels[version]
+        if pair is not None and pair not in kernels:
+            kernels[pair] = decay_kernel(mceq, *pair)
+    return kernels
+
+
+# accuracies of accuracy='auto', their E_CR grids are nested
+ACCURACIES = (1, 1.9, 3.7, 7.3)
+
+
+def flatten(res):
+    """Passed and total fluxes of a result of fluxes as one array"""
+    if isinstance(res, dict):
+        return np.concatenate([flatten(res[kind]) for kind in sorted(res)])
+    return np.ravel(np.asarray(res, dtype=float))
+
+
+def converge(evaluate, auto_rtol, pruned=False, accuracies=ACCURACIES):
+    """Evaluates evaluate(accuracy) at increasing accuracies until two
+    successive results agree within auto_rtol
+
+    The E_CR points, and with them the MCEq solutions, of the coarser
+    accuracies are reused by the finer ones.
+
+    Args:
+        pruned (bool): evaluate returns (result, pruning report), see
+        nuVeto.get_fluxes
+    Returns:
+        (result, report), report holds the accuracy of result, the relative
+        change to the previous accuracy, whether it converged, the
+        accuracies evaluated, the seconds spent and, if pruned, the pruning
+        report of result
+    """
+    start = time.time()
+    prev = None
+    change = np.inf
+    for iacc, accuracy in enumerate(accuracies):
+        res = evaluate(accuracy)
+        if pruned:
+            res, pruning = res
+        vals = flatten(res)
+        if prev is not None:
+            with np.errstate(divide='ignore', invalid='ignore'):
+                change = np.max(np.nan_to_num(np.abs(vals-prev)/np.abs(vals)))
+            if change <= auto_rtol:
+                break
+        prev = vals
+    report = {'accuracy':accuracy, 'change':change, 'converged':change <= auto_rtol,
+              'accuracies':list(accuracies[:iacc+1]), 'seconds':time.time()-start}
+    if pruned:
+        report['pruning'] = pruning
+    return res, report
 
 
 @lru_cache(maxsize=2**12)
-def builder(cos_theta, pmodel, hadr, barr_mods, depth, density):
-    return nuVeto(cos_theta, pmodel, hadr, barr_mods, depth, density)
+def builder(cos_theta, pmodel, hadr, barr_mods, depth, density, xtol=None):
+    return nuVeto(cos_theta, pmodel, hadr, barr_mods, depth, density, xtol)
+
+
+def reported(accuracy, rtol):
+    """Whether fluxes and passing return (result, report)"""
+    return accuracy == 'auto' or rtol is not None
+
+
+def passing(enu, cos_theta, kind='conv_numu', pmodel=('HillasGaisser2012', 'H3a'), hadr='SIBYLL2.3c', barr_mods=(), depth=1950*Units.m, density=('CORSIKA', ('SouthPole', 'June')), accuracy=3.5, fraction=True, prpl='ice_allm97_step_1', corr_only=False, store=None, rtol=None, matrices=False, xtol=None, auto_rtol=1e-3):
+    res = fluxes(enu, cos_theta, kind, pmodel, hadr, barr_mods, depth, density, accuracy, prpl, corr_only, store, rtol, matrices, xtol, auto_rtol)
+    if reported(accuracy, rtol):
+        res, report = res
+        return to_passing(res, kind, prpl, fraction), report
+    return to_passing(res, kind, prpl, fraction)
 
 
-def passing(enu, cos_theta, kind='conv_numu', pmodel=(pm.HillasGaisser2012, 'H3a'), hadr='SIBYLL2.3c', barr_mods=(), depth=1950*Units.m, density=('CORSIKA', ('SouthPole', 'June')), accuracy=3.5, fraction=True, prpl='ice_allm97_step_1', corr_only=False):
-    sv = builder(cos_theta, pmodel, hadr, barr_mods, depth, density)
-    num, den = sv.get_fluxes(enu, kind, accuracy, prpl, corr_only)
+def to_passing(res, kind, prpl, fraction=True):
+    """Converts the result of fluxes to the one of passing"""
+    if isinstance(kind, (list, tuple)):
+        return dict((kind_, to_passing(val, kind_, prpl, fraction)) for kind_, val in res.items())
+    if isinstance(prpl, (list, tuple)):
+        return [num/den if fraction else num for num, den in res]
+    num, den = res
     return num/den if fraction else num
 
 
-def fluxes(enu, cos_theta, kind='conv_numu', pmodel=(pm.HillasGaisser2012, 'H3a'), hadr='SIBYLL2.3c', barr_mods=(), depth=1950*Units.m, density=('CORSIKA', ('SouthPole', 'June')), accuracy=3.5, prpl='ice_allm97_step_1', corr_only=False):
-    sv = builder(cos_theta, pmodel, hadr, barr_mods, depth, density)
-    return sv.get_fluxes(enu, kind, accuracy, prpl, corr_only)
+def fluxes(enu, cos_theta, kind='conv_numu', pmodel=('HillasGaisser2012', 'H3a'), hadr='SIBYLL2.3c', barr_mods=(), depth=1950*Units.m, density=('CORSIKA', ('SouthPole', 'June')), accuracy=3.5, prpl='ice_allm97_step_1', corr_only=False, store=None, rtol=None, matrices=False, xtol=None, auto_rtol=1e-3):
+    """Returns the passing and total flux
+
+    Args:
+        kind: a kind or a sequence of them, in which case a dict of the
+        results of each kind is returned from a single pass
+        prpl: a prpl model or a sequence of them, in which case a list of
+        (passed, total) is returned from a single pass
+        store (ResultStore): if given, results are looked up in and added to
+        this persistent store
+        rtol (float): relative tolerance for pruning the E_CR integral,
+        (result, report) is returned then, see nuVeto.get_fluxes. The report
+        covers the values computed in this call, stored ones have no 'ecrs'
+        matrices (bool): use the cached interpolation matrices, see nuVeto.get_fluxes
+        xtol (float): adapt the depth grids to this tolerance, see
+        nuVeto.adapt_depths
+        accuracy: 'auto' returns (result, report) for the first of the
+        ACCURACIES that agrees within auto_rtol with the previous one, see
+        converge. Each accuracy is pruned with rtol, and looked up in and
+        added to the store
+    """
+    if accuracy == 'auto':
+        return converge(lambda accuracy: fluxes(enu, cos_theta, kind, pmodel, hadr, barr_mods, depth, density,
+                                                accuracy, prpl, corr_only, store, rtol, matrices, xtol),
+                        auto_rtol, rtol is not None)
+    kinds = list(kind) if isinstance(kind, (list, tuple)) else [kind]
+    prpls = list(prpl) if isinstance(prpl, (list, tuple)) else [prpl]
+    pairs = [(kind_, prpl_) for kind_ in kinds for prpl_ in prpls]
+    vals = [None]*len(pairs)
+    if store is not None:
+        args = [dict(enu=enu, cos_theta=cos_theta, kind=kind_, pmodel=pmodel, hadr=hadr,
+                     barr_mods=barr_mods, depth=depth, density=density,
+                     accuracy=accuracy, prpl=prpl_, corr_only=corr_only, rtol=rtol, matrices=matrices,
+                     xtol=xtol)
+                for kind_, prpl_ in pairs]
+        vals = store.get_many(args)
+    todo = [idx for idx, stored in enumerate(vals) if stored is None]
+    report = {'rtol':rtol, 'ecrs':{}, 'tail':0.}
+    if todo:
+        todo_kinds = []
+        todo_prpls = []
+        for idx in todo:
+            kind_, prpl_ = pairs[idx]
+            if kind_ not in todo_kinds:
+                todo_kinds.append(kind_)
+            if prpl_ not in todo_prpls:
+                todo_prpls.append(prpl_)
+        sv = builder(cos_theta, pmodel, hadr, barr_mods, depth, density, xtol)
+        res = sv.get_fluxes(enu, todo_kinds, accuracy, todo_prpls, corr_only, rtol=rtol, matrices=matrices)
+        if rtol is not None:
+            res, report = res
+        for idx in todo:
+            kind_, prpl_ = pairs[idx]
+            vals[idx] = res[kind_][todo_prpls.index(prpl_)]
+        if store is not None:
+            store.put_many([(args[idx], vals[idx]) for idx in todo])
+    res = {}
+    for ikind, kind_ in enumerate(kinds):
+        res[kind_] = vals[ikind*len(prpls):(ikind+1)*len(prpls)]
+        if not isinstance(prpl, (list, tuple)):
+            res[kind_] = res[kind_][0]
+    res = res if isinstance(kind, (list, tuple)) else res[kind]
+    return res if rtol is None else (res, report)
+
+
+# arguments of fluxes that batch computations can set, with their defaults
+_argspec = inspect.getargspec(fluxes)
+DEFAULTS = dict(zip(_argspec.args[-len(_argspec.defaults):], _argspec.defaults))
+for _arg in ('enu', 'cos_theta', 'store'):
+    DEFAULTS.pop(_arg, None)
+
+
+def check(kwargs, what, fixed=('kind',)):
+    """Returns the fluxes arguments of kwargs with the defaults
+
+    The arguments in fixed are set by the caller and left out. what names the
+    computation in the errors.
+    """
+    unknown = set(kwargs) - (set(DEFAULTS) - set(fixed))
+    if unknown:
+        raise TypeError('Unknown arguments {}'.format(sorted(unknown)))
+    args = dict(DEFAULTS, **kwargs)
+    for arg in fixed:
+        args.pop(arg)
+    if args['accuracy'] == 'auto':
+        raise ValueError("{} need a fixed accuracy, not 'auto'".format(what))
+    return args
+
+
+@contextmanager
+def workers(nproc, initializer=None, initargs=()):
+    """Yields imap(fn, tasks), which maps fn over tasks on nproc processes or
+    inline if nproc is 1
+
+    imap hands consecutive tasks to the same process, in chunks of
+    len(tasks)//(4*nproc), so tasks sorted by cos_theta share the builder of
+    their MCEq run. initializer(*initargs) is run in each of the processes.
+    """
+    if nproc <= 1:
+        yield lambda fn, tasks: (fn(task) for task in tasks)
+        return
+    pool = Pool(nproc, initializer, initargs)
+    try:
+        yield lambda fn, tasks: pool.imap(fn, tasks, max(len(tasks)//(4*nproc), 1))
+    finally:
+        pool.close()
+        pool.join()
+
+
+def response(enu, cos_theta, kind='conv_numu', pmodel=('HillasGaisser2012', 'H3a'), hadr='SIBYLL2.3c', barr_mods=(), depth=1950*Units.m, density=('CORSIKA', ('SouthPole', 'June')), accuracy=3.5, prpl='ice_allm97_step_1', matrices=False, particles=None, xtol=None):
+    """Returns the Response of fluxes to the primary flux, see nuVeto.get_response
+
+    pmodel only sets the default primaries, the response is reweighted to
+    any CR model with Response.fluxes or Response.passing.
+    """
+    sv = builder(cos_theta, pmodel, hadr, barr_mods, depth, density, xtol)
+    return sv.get_response(enu, kind, accuracy, prpl, matrices=matrices, particles=particles)
+
+
+def fluxes_depths(enu, cos_theta, depths, kind='conv_numu', pmodel=('HillasGaisser2012', 'H3a'), hadr='SIBYLL2.3c', barr_mods=(), density=('CORSIKA', ('SouthPole', 'June')), accuracy=3.5, prpl='ice_allm97_step_1', corr_only=False, ctol=1e-3, rtol=None, matrices=False, xtol=None):
+    """Returns the passing and total flux for each of the detector depths
+
+    Depths whose effective zenith agrees within ctol in cos(theta) share the
+    atmospheric solutions of one MCEq run, only the overburden dependent terms
+    are recomputed per depth. With rtol, each is a (result, report), see
+    nuVeto.get_fluxes.
+    """
+    cths = [Geometry(depth).cos_theta_eff(cos_theta) for depth in depths]
+    res = [None]*len(depths)
+    ref = None
+    for idx in np.argsort(cths):
+        if ref is None or cths[idx]-cths[ref] > ctol:
+            ref = idx
+            sv = builder(cos_theta, pmodel, hadr, barr_mods, depths[ref], density, xtol)
+        res[idx] = sv.get_fluxes(enu, kind, accuracy, prpl, corr_only,
+                                 Geometry(depths[idx]).overburden(cos_theta), rtol, matrices)
+    return res
@@ -0,0 +1,213 @@
+#!/usr/bin/env python
+"""
+Generates the (E_nu/E_D, E_mu/E_D) decay distributions in
+data/decay_distributions without pythia8
+
+Semileptonic decays into a muon neutrino and its sibling muon are generated
+in batches with a vectorized n-body phase-space generator (GENBOD). Decays to
+a single pseudoscalar are weighted with the V-A matrix element and a
+single-pole form factor; all other channels follow phase space. The mothers
+are boosted to 1 TeV as in the pythia8 script.
+
+Run as
+./decay.py -n 10000000 -j 8 -o ../../data/decay_distributions
+"""
+import os
+import argparse
+from multiprocessing import Pool
+import numpy as np
+from nuVeto import datafile
+
+
+MMU = 0.10566
+# mother: (mass, file prefix, [(branching ratio, hadron masses, pole mass), ...])
+# the pole mass is None for channels that follow phase space
+CHANNELS = {
+    'D+': (1.86962, 'D+', [(0.0004, [], None),
+                           (0.0043, [0.13498], 2.010),
+                           (0.0028, [0.77526], None),
+                           (0.0026, [0.54786], 2.010),
+                           (0.0028, [0.78265], None),
+                           (0.0874, [0.49761], 2.112),
+                           (0.0533, [0.89594], None),
+                           (0.0038, [1.4324], None),
+                           (0.0005, [0.95778], 2.010),
+                           (0.0036, [1.272], None),
+                           (0.0014, [0.49761, 0.13498], None),
+                           (0.0027, [0.49368, 0.13957], None)]),
+    'D0': (1.86486, 'D0', [(0.0034, [0.13957], 2.010),
+                           (0.0022, [0.77526], None),
+                           (0.034, [0.49368], 2.112),
+                           (0.0214, [0.89166], None),
+                           (0.0015, [1.4256], None),
+                           (0.0014, [1.272], None),
+                           (0.0011, [0.49761, 0.13957], None),
+                           (0.0006, [0.49368, 0.13498], None)]),
+    'Ds+': (1.96849, 'Ds', [(0.00616, [], None),
+                            (0.0307, [0.54786], 2.112),
+                            (0.0027, [0.49761], 2.010),
+                            (0.001, [0.89594], None),
+                            (0.0106, [0.95778], 2.112),
+                            (0.0242, [1.01946], None)]),
+    'K+': (0.49368, 'K+', [(0.6343, [], None),
+                           (0.0332, [0.13498], 0.89166)]),
+    'K0L': (0.49761, 'K0L', [(0.13509, [0.13957], 0.89166)])
+}
+
+
+def dot(a, b):
+    """ Minkowski product of (..., 4) arrays of (px, py, pz, E)
+    """
+    return a[...,3]*b[...,3] - np.sum(a[...,:3]*b[...,:3], axis=-1)
+
+
+def pdk(a, b, c):
+    """ Momentum of the daughters in a two-body decay a -> b c
+    """
+    return np.sqrt(np.maximum((a**2-(b+c)**2)*(a**2-(b-c)**2), 0))/(2*a)
+
+
+def boost(p, beta):
+    """ Boosts the (n, 4) momenta p by the (n, 3) velocities beta
+    """
+    b2 = np.sum(beta**2, axis=-1)
+    gamma = 1/np.sqrt(1-b2)
+    bp = np.sum(beta*p[:,:3], axis=-1)
+    gamma2 = np.where(b2 > 0, (gamma-1)/np.where(b2 > 0, b2, 1), 0)
+    out = np.empty_like(p)
+    out[:,:3] = p[:,:3] + (gamma2*bp + gamma*p[:,3])[:,None]*beta
+    out[:,3] = gamma*(p[:,3] + bp)
+    return out
+
+
+def isotropic(pmag, rs):
+    """ (n, 3) momenta of magnitude pmag in random directions
+    """
+    cth = rs.uniform(-1, 1, pmag.shape)
+    phi = rs.uniform(0, 2*np.pi, pmag.shape)
+    sth = np.sqrt(1-cth**2)
+    return pmag[:,None]*np.stack([sth*np.cos(phi), sth*np.sin(phi), cth], axis=-1)
+
+
+def genbod(mass, masses, n, rs):
+    """ Generates n decays of mass into masses in the rest frame
+
+    :returns: list of (n, 4) momenta for each daughter and the (n,)
+    phase-space weights
+    """
+    masses = np.asarray(masses, float)
+    nbody = len(masses)
+    tecm = mass - masses.sum()
+    rnd = np.sort(rs.uniform(size=(n, nbody-2)), axis=1)
+    rnd = np.concatenate([np.zeros((n, 1)), rnd, np.ones((n, 1))], axis=1)
+    invmas = rnd*tecm + np.cumsum(masses)[None,:]
+    pd = pdk(invmas[:,1:], invmas[:,:-1], masses[None,1:])
+    weight = np.prod(pd, axis=1)
+
+    p3 = isotropic(pd[:,0], rs)
+    moms = [np.concatenate([p3, np.sqrt(pd[:,0]**2+masses[0]**2)[:,None]], axis=1),
+            np.concatenate([-p3, np.sqrt(pd[:,0]**2+masses[1]**2)[:,None]], axis=1)]
+    for i in range(1, nbody-1):
+        p3 = isotropic(pd[:,i], rs)
+        esub = np.sqrt(pd[:,i]**2+invmas[:,i]**2)
+        moms = [boost(mom, -p3/esub[:,None]) for mom in moms]
+        moms.append(np.concatenate([p3, np.sqrt(pd[:,i]**2+masses[i+1]**2)[:,None]], axis=1))
+    return moms, weight
+
+
+def semileptonic(mass, hadrons, pole, n, rs):
+    """ Generates n decays mother -> mu nu hadrons in the rest frame
+
+    :returns: (n, 4) momenta of the muon and the neutrino and the (n,) weights
+    """
+    moms, weight = genbod(mass, [MMU, 0.]+list(hadrons), n, rs)
+    pmu, pnu = moms[:2]
+    if pole is not None:
+        # V-A with a pseudoscalar hadron, f_- terms neglected
+        pmother = np.zeros((n, 4))
+        pmother[:,3] = mass
+        pp = pmother + moms[2]
+        q2 = dot(pmu+pnu, pmu+pnu)
+        ffp = 1/(1-q2/pole**2)
+        weight = weight*ffp**2*np.maximum(2*dot(pp, pmu)*dot(pp, pnu) - dot(pp, pp)*dot(pmu, pnu), 0)
+    return pmu, pnu, weight
+
+
+def hist_chunk(args):
+    """ Histograms one chunk of n decays of mother at momentum pmom, each
+    channel normalized to its branching ratio
+
+    Seeds are derived from (seed, chunk) so results do not depend on how
+    chunks are distributed over processes.
+    """
+    mother, n, chunk, seed, pmom, xedges = args
+    rs = np.random.RandomState([seed, chunk])
+    mass, _, channels = CHANNELS[mother]
+    energy = np.sqrt(mass**2+pmom**2)
+    gamma, beta = energy/mass, pmom/energy
+    brtot = sum(channel[0] for channel in channels)
+    hist = np.zeros((len(xedges)-1, len(xedges)-1))
+    for br, hadrons, pole in channels:
+        nchan = max(int(round(n*br/brtot)), 1)
+        if hadrons:
+            pmu, pnu, weight = semileptonic(mass, hadrons, pole, nchan, rs)
+        else:
+            p3 = isotropic(np.full(nchan, pdk(mass, MMU, 0.)), rs)
+            pmu = np.concatenate([p3, np.sqrt(np.sum(p3**2, axis=1)+MMU**2)[:,None]], axis=1)
+            pnu = np.concatenate([-p3, np.sqrt(np.sum(p3**2, axis=1))[:,None]], axis=1)
+            weight = np.ones(nchan)
+        # boost along z to the lab frame
+        xnu = gamma*(pnu[:,3] + beta*pnu[:,2])/energy
+        xmu = gamma*(pmu[:,3] + beta*pmu[:,2])/energy
+        hist += np.histogram2d(xnu, xmu, bins=[xedges, xedges],
+                               weights=weight*br/weight.sum())[0]
+    return hist
+
+
+def histograms(mother, n=1000000, nproc=1, seed=0, chunksize=100000, pmom=1.e3, xedges=np.linspace(0, 1, 101)):
+    """ Returns the decay distribution in the format read by nuVeto.nbody
+
+    Row i is the E_mu/E_D distribution for E_nu/E_D in bin i, with an extra
+    final row for E_nu/E_D = 1.
+    """
+    sizes = [chunksize]*(n//chunksize) + ([n%chunksize] if n%chunksize else [])
+    tasks = [(mother, size, chunk, seed, pmom, xedges) for chunk, size in enumerate(sizes)]
+    if nproc > 1:
+        pool = Pool(nproc)
+        try:
+            hists = pool.map(hist_chunk, tasks)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        hists = [hist_chunk(task) for task in tasks]
+    # chunks are weighted by their number of decays
+    hist = np.sum([size*hist for size, hist in zip(sizes, hists)], axis=0)
+    with np.errstate(invalid='ignore'):
+        hist = hist/hist.sum(axis=1, keepdims=True)
+    ceros = np.zeros(len(xedges)-1)
+    ceros[0] = 1.
+    return np.vstack([hist, ceros])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Generate decay distributions for nuVeto.nbody')
+    parser.add_argument('--mothers', nargs='+', default=sorted(CHANNELS.keys()),
+                        choices=sorted(CHANNELS.keys()))
+    parser.add_argument('-n', dest='n', type=int, default=1000000,
+                        help='number of decays per mother')
+    parser.add_argument('-j', dest='nproc', type=int, default=1,
+                        help='number of processes')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--nbins', type=int, default=100)
+    parser.add_argument('-o', dest='outdir', default='.',
+                        help='output directory. To be read in this needs to be "nuVeto/data/decay_distributions/"')
+
+    args = parser.parse_args()
+    xedges = np.linspace(0, 1, args.nbins+1)
+    for mother in args.mothers:
+        hists = histograms(mother, args.n, args.nproc, args.seed, xedges=xedges)
+        fname = os.path.join(args.outdir, '{}_numu.nvd'.format(CHANNELS[mother][1]))
+        datafile.write(fname, {'histograms':hists, 'xedges':xedges}, {'type':'arrays'})
+        print('Output saved into {}'.format(fname))
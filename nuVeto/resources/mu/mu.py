@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 
 import os
+import sys
 from collections import namedtuple
 import pickle
 import gzip
@@ -10,6 +11,7 @@ import pandas as pd
 from scipy import interpolate
 import pl
 from nuVeto.utils import calc_bins, centers
+from nuVeto import datafile
 
 
 def hist_preach(infile):
@@ -31,10 +33,50 @@ def hist_preach(infile):
     return np.asarray(preach)
 
 
+def hist_preach_stream(stream, chunksize=2**20):
+    """ Builds histograms of P_reach from MMC output read off a stream
+
+    The MMC output is consumed in chunks and each (ei, l) block is
+    histogrammed as soon as it is complete, so the raw text never needs to be
+    stored. This relies on MMC preserving the input order of reaching.py,
+    where all samples of a given (ei, l) are contiguous.
+    """
+    Hist = namedtuple('Hist', 'counts edges')
+    preach = []
+    def _fill(block):
+        ei, l = block[0, :2]
+        bins = calc_bins(block[:, 2])
+        histo = Hist(*np.histogram(block[:, 2], bins=bins, density=True))
+        preach.extend([(ei, l, ef, ew, val) for ef, ew, val in zip(centers(histo.edges),
+                                                                   np.ediff1d(histo.edges),
+                                                                   histo.counts)])
+
+    tail = np.empty((0, 3))
+    for chunk in pd.read_csv(stream, delim_whitespace=True, header=None,
+                             names='ei l ef'.split(), chunksize=chunksize):
+        vals = np.concatenate([tail, chunk.values])
+        # If the muon doesn't reach, MMC saves ef as -distance traveled
+        vals[vals<0] = 0
+        edges = np.flatnonzero(np.any(np.diff(vals[:, :2], axis=0) != 0, axis=1))+1
+        blocks = np.split(vals, edges)
+        # the last block may continue into the next chunk
+        for block in blocks[:-1]:
+            _fill(block)
+        tail = blocks[-1]
+    if len(tail):
+        _fill(tail)
+
+    preach = np.asarray(preach)
+    # same ordering as the groupby in hist_preach
+    return preach[np.lexsort((preach[:, 1], preach[:, 0]))]
+
+
 def int_ef(preach, plight):
     """ integate p_reach*p_light over e_f to reduce dimensionality for interpolator
     """
-    if isinstance(preach, str) and os.path.isfile(preach):
+    if isinstance(preach, str) and preach == '-':
+        preach = hist_preach_stream(sys.stdin)
+    elif isinstance(preach, str) and os.path.isfile(preach):
         try:
             preach = pickle.load(gzip.open(preach, 'rb'))
         except IOError:
@@ -58,20 +100,23 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser(
         description='Generate muon detection probability')
     parser.add_argument('mmc', metavar='MMC',
-                    help='text file or pickled histogram containing MMC simulated data')
+                    help='text file or pickled histogram containing MMC simulated data, or - to read MMC output from stdin')
     parser.add_argument('--plight', default='pl_step_1000',
                         choices=[fn for fn in dir(pl) if fn.startswith('pl_')],
                         help='choice of a plight function to apply as defined in pl.py')
     parser.add_argument('--noconvolution', default=False, action='store_true',
                         help='Generate pdfs of preach from raw MMC output and save to pklz')
-    parser.add_argument('-o', dest='output', default='mu.pkl',
+    parser.add_argument('-o', dest='output', default='mu.nvd',
                         help='output file. To be read in this needs to be in "nuVeto/data/prpl/"')
 
     args = parser.parse_args()
     if args.noconvolution:
-        hpr = hist_preach(args.mmc)
+        if args.mmc == '-':
+            hpr = hist_preach_stream(sys.stdin)
+        else:
+            hpr = hist_preach(args.mmc)
         pickle.dump(hpr, gzip.open(args.output, 'wb'))
     else:
         intp = interp(args.mmc, getattr(pl, args.plight))
-        pickle.dump(intp, open(args.output, 'w'))
-    print 'Output pickled into {}'.format(args.output)
+        datafile.write(args.output, *datafile.pack(intp))
+    print 'Output saved into {}'.format(args.output)
@@ -5,6 +5,9 @@ Generates initial muon energies and overburdens for input to MMC
 Run as
 ./reaching.py | ./ammc -raw -user -sdec -lpm -bs=1 -ph=3 -bb=2 -sh=2 -scat -medi=ice -frho -f -r -vcut=1e-3 -cont > reaching.txt &
 
+or, to histogram the MMC output on the fly without storing the raw text,
+./reaching.py | ./ammc [...] | ./mu.py --noconvolution -o mmc/ice.pklz -
+
 From https://icecube.wisc.edu/~dima/work/MUONPR/MUON/WEBMMC/HISTORY.TXT
     "Several new cross sections are implemented: Andreev, Bezrukov, and Bugaev
     (abb) parameterization of the bremsstrahlung cross section can now be selected
@@ -27,16 +30,37 @@ From https://icecube.wisc.edu/~dima/work/MUONPR/MUON/WEBMMC/HISTORY.TXT
     Hadronic channels of the tau decay are now described as two-body decays into a
     tau neutrino and a pion or a rho-770, a1-1260, or rho-1450 resonance."
 """
+import sys
+import argparse
 import numpy as np
 
-nsamples = 1000
-xvec = np.logspace(np.log10(1./1000), np.log10(1./(2e5)), 100)
-emuis = np.logspace(2, 8, 100)
-
-for distance in 1/xvec:
-    for emui in emuis:
-        # roughly assume 1GeV/4m minimum energy loss
-        if emui < distance/4.:
-            continue
-        for i in xrange(nsamples):
-            print emui, distance
+
+def grid(emuis=np.logspace(2, 8, 100),
+         distances=1/np.logspace(np.log10(1./1000), np.log10(1./(2e5)), 100)):
+    """ Returns the (emui, distance) pairs to simulate, ordered by distance
+    then energy
+    """
+    dd, ee = np.meshgrid(distances, emuis, indexing='ij')
+    # roughly assume 1GeV/4m minimum energy loss
+    sel = ee >= dd/4.
+    return np.stack([ee[sel], dd[sel]], axis=-1)
+
+
+def generate(out=sys.stdout, nsamples=1000, **kwargs):
+    """ Writes nsamples copies of each (emui, distance) line to out
+
+    Each block of identical lines is written with a single call so the
+    stream can be piped straight into MMC without a Python-level loop over
+    samples.
+    """
+    for emui, distance in grid(**kwargs):
+        out.write('{!s} {!s}\n'.format(emui, distance)*nsamples)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Generate initial muon energies and overburdens for MMC')
+    parser.add_argument('-n', dest='nsamples', type=int, default=1000,
+                        help='number of samples per (emui, distance) pair')
+    args = parser.parse_args()
+    generate(sys.stdout, args.nsamples)
@@ -0,0 +1,143 @@
+"""Persistent store for passing fractions and fluxes
+
+Results of nuveto.fluxes are memoized in a SQLite file keyed on the full,
+canonicalized argument set together with the package and data versions, so
+repeated requests across sessions are served without recomputation.
+"""
+
+import os
+import numbers
+import hashlib
+import sqlite3
+import threading
+from functools32 import lru_cache
+from pkg_resources import resource_filename, get_distribution, DistributionNotFound
+
+
+ARGS = ('enu', 'cos_theta', 'kind', 'pmodel', 'hadr', 'barr_mods', 'depth',
+        'density', 'accuracy', 'prpl', 'corr_only', 'rtol', 'matrices', 'xtol', 'auto_rtol')
+# arguments added later and their defaults
+OPTIONAL = {'rtol':None, 'matrices':False, 'xtol':None, 'auto_rtol':1e-3}
+
+
+def md5sum(fpath):
+    md5 = hashlib.md5()
+    with open(fpath, 'rb') as f:
+        for block in iter(lambda: f.read(2**20), b''):
+            md5.update(block)
+    return md5.hexdigest()
+
+
+@lru_cache(1)
+def version():
+    """ Returns the stamp of the package version and the bundled data
+    """
+    try:
+        pkg = get_distribution('nuVeto').version
+    except DistributionNotFound:
+        pkg = 'unknown'
+    md5 = hashlib.md5()
+    root = resource_filename('nuVeto', 'data')
+    for dirpath, dirnames, fnames in sorted(os.walk(root)):
+        for fname in sorted(fnames):
+            fpath = os.path.join(dirpath, fname)
+            md5.update('{} {}'.format(os.path.relpath(fpath, root), md5sum(fpath)).encode())
+    return '{}-{}'.format(pkg, md5.hexdigest()[:12])
+
+
+def canonical(value):
+    """ Returns a stable string representation of an argument value
+    """
+    if isinstance(value, (tuple, list)):
+        return '({})'.format(','.join(canonical(val) for val in value))
+    elif isinstance(value, type):
+        # CR model classes and their names share a key
+        return repr(value.__name__)
+    elif isinstance(value, numbers.Number) and not isinstance(value, bool):
+        return repr(float(value))
+    return repr(value)
+
+
+def key(**kwargs):
+    """ Returns the store key for the arguments of nuveto.fluxes
+    """
+    kwargs = dict(OPTIONAL, **kwargs)
+    missing = set(ARGS) - set(kwargs)
+    if missing:
+        raise TypeError('Missing arguments {}'.format(sorted(missing)))
+    if isinstance(kwargs['prpl'], str) and os.path.isfile(kwargs['prpl']):
+        # user-supplied prpl files are keyed on their contents
+        kwargs['prpl'] = 'file:{}'.format(md5sum(kwargs['prpl']))
+    # optional arguments at their default keep the keys stored before them
+    text = '|'.join('{}={}'.format(arg, canonical(kwargs[arg])) for arg in ARGS
+                    if arg not in OPTIONAL or kwargs[arg] != OPTIONAL[arg])
+    return hashlib.sha1('{}|{}'.format(version(), text).encode()).hexdigest()
+
+
+class ResultStore(object):
+    """SQLite-backed memoization of (passed, total) fluxes, with one
+    connection per thread
+    """
+    def __init__(self, path=None):
+        """
+        Args:
+            path (str): the SQLite file. Defaults to $NUVETO_STORE or
+            ~/.nuVeto/results.sqlite
+        """
+        if path is None:
+            path = os.environ.get('NUVETO_STORE',
+                                  os.path.join(os.path.expanduser('~'), '.nuVeto', 'results.sqlite'))
+        dirname = os.path.dirname(os.path.abspath(path))
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        self.path = path
+        self.local = threading.local()
+        with self.conn:
+            self.conn.execute('CREATE TABLE IF NOT EXISTS results '
+                              '(key TEXT PRIMARY KEY, passed REAL, total REAL)')
+
+
+    @property
+    def conn(self):
+        """SQLite connection of the calling thread, connections cannot be
+        shared between threads
+        """
+        if not hasattr(self.local, 'conn'):
+            self.local.conn = sqlite3.connect(self.path, timeout=60)
+        return self.local.conn
+
+
+    def get(self, **kwargs):
+        """Returns the stored (passed, total) or None"""
+        return self.get_many([kwargs])[0]
+
+
+    def put(self, value, **kwargs):
+        """Stores value=(passed, total) for the arguments of nuveto.fluxes"""
+        self.put_many([(kwargs, value)])
+
+
+    def get_many(self, kwargs_list):
+        """Returns the stored (passed, total) or None for each set of arguments"""
+        keys = [key(**kwargs) for kwargs in kwargs_list]
+        found = {}
+        # stay below the SQLite limit on host parameters
+        for start in range(0, len(keys), 500):
+            block = keys[start:start+500]
+            found.update(
+                (row[0], (row[1], row[2])) for row in self.conn.execute(
+                    'SELECT key, passed, total FROM results WHERE key IN ({})'.format(
+                        ','.join('?'*len(block))), block))
+        return [found.get(k) for k in keys]
+
+
+    def put_many(self, items):
+        """Stores a sequence of (arguments, (passed, total)) in one transaction"""
+        with self.conn:
+            self.conn.executemany(
+                'INSERT OR REPLACE INTO results VALUES (?, ?, ?)',
+                [(key(**kwargs), float(value[0]), float(value[1])) for kwargs, value in items])
+
+
+    def __len__(self):
+        return self.conn.execute('SELECT COUNT(*) FROM results').fetchone()[0]
@@ -0,0 +1,151 @@
+"""Compact surrogates of passing fractions
+
+A surrogate is a tensor-product Chebyshev expansion of the passing fraction of
+one configuration in (log10 enu, cos_theta). The degrees are doubled one
+dimension at a time until the error on held-out points, the nodes of the next
+refinement of each dimension, is below the target. The coefficients take a
+few kilobytes and are evaluated vectorized.
+"""
+
+import numpy as np
+from numpy.polynomial import chebyshev
+from nuVeto import nuveto
+
+
+def nodes(n):
+    """Chebyshev extrema of degree n on [-1, 1], nested under doubling"""
+    return np.cos(np.pi*np.arange(n+1)/n)[::-1]
+
+
+class Surrogate(object):
+    """Chebyshev expansion of a passing fraction"""
+    def __init__(self, coeffs, lenu_range, cos_theta_range, error, kind='conv_numu', args=None):
+        """
+        Args:
+            coeffs (array): coefficients with shape (degree in log10 enu + 1,
+            degree in cos_theta + 1)
+            lenu_range, cos_theta_range: the domain
+            error (float): maximal absolute error on the held-out points
+        """
+        self.coeffs = np.asarray(coeffs)
+        self.lenu_range = tuple(lenu_range)
+        self.cos_theta_range = tuple(cos_theta_range)
+        self.error = error
+        self.kind = kind
+        self.args = args
+
+
+    @staticmethod
+    def scale(val, val_range):
+        return (2*np.asarray(val, dtype=float)-val_range[0]-val_range[1])/(val_range[1]-val_range[0])
+
+
+    def __call__(self, enu, cos_theta):
+        """Passing fraction, nan outside of the domain"""
+        x, y = np.broadcast_arrays(self.scale(np.log10(enu), self.lenu_range),
+                                   self.scale(cos_theta, self.cos_theta_range))
+        res = chebyshev.chebval2d(x, y, self.coeffs)
+        return np.where((np.abs(x) <= 1+1e-12) & (np.abs(y) <= 1+1e-12), res, np.nan)
+
+
+    def dump(self, fpath):
+        np.savez(fpath, coeffs=self.coeffs, lenu_range=self.lenu_range,
+                 cos_theta_range=self.cos_theta_range, error=self.error, kind=self.kind,
+                 args=repr(sorted(self.args.items())) if self.args is not None else '')
+
+
+    @classmethod
+    def load(cls, fpath):
+        """Reads a surrogate written by dump, args are kept as text"""
+        with np.load(fpath) as sfile:
+            return cls(sfile['coeffs'], sfile['lenu_range'], sfile['cos_theta_range'],
+                       sfile['error'].item(), str(sfile['kind']), str(sfile['args']) or None)
+
+
+def fit(fn, lenu_range, cos_theta_range, target=1e-3, degrees=(4, 2), max_degree=64):
+    """Fits a Chebyshev expansion of fn(log10 enus, cos_thetas)
+
+    fn is evaluated on arrays of points and each point once. At degrees (n,
+    m) the expansion interpolates the (n+1)x(m+1) extrema grid and is
+    validated against the extrema of (2n, m) and (n, 2m). The dimension with
+    the larger held-out error is refined until both are below target.
+
+    degrees and max_degree are powers of 2, so the nodes of every grid are
+    nodes of the (2*max_degree, 2*max_degree) grid.
+
+    Returns:
+        (coeffs, error), error is the held-out error, above target if
+        max_degree was reached
+    """
+    for degree in tuple(degrees)+(max_degree,):
+        if degree < 1 or degree & (degree-1):
+            raise ValueError('Degrees must be powers of 2, not {}'.format(degree))
+    if max(degrees) > max_degree:
+        raise ValueError('The degrees {} exceed max_degree {}'.format(degrees, max_degree))
+    vals = {}
+    fine = 2*max_degree
+    def grid(n, m):
+        lenus = (nodes(n)+1)/2*(lenu_range[1]-lenu_range[0])+lenu_range[0]
+        cths = (nodes(m)+1)/2*(cos_theta_range[1]-cos_theta_range[0])+cos_theta_range[0]
+        # the nodes are nested, key them on their index in the finest grid
+        keys = [(i*(fine//n), j*(fine//m)) for i in range(n+1) for j in range(m+1)]
+        todo = [k for k in keys if k not in vals]
+        if todo:
+            vals.update(zip(todo, fn(np.array([lenus[i//(fine//n)] for i, j in todo]),
+                                     np.array([cths[j//(fine//m)] for i, j in todo]))))
+        return np.array([vals[k] for k in keys]).reshape(n+1, m+1)
+
+    n, m = degrees
+    while True:
+        coeffs = coefficients(grid(n, m))
+        errors = []
+        for n_, m_ in ((2*n, m), (n, 2*m)):
+            x, y = np.meshgrid(nodes(n_), nodes(m_), indexing='ij')
+            errors.append(np.max(np.abs(chebyshev.chebval2d(x, y, coeffs)-grid(n_, m_))))
+        if max(errors) < target:
+            return coeffs, max(errors)
+        if errors[0] >= errors[1]:
+            if 2*n > max_degree:
+                return coeffs, max(errors)
+            n *= 2
+        else:
+            if 2*m > max_degree:
+                return coeffs, max(errors)
+            m *= 2
+
+
+def coefficients(vals):
+    """Chebyshev coefficients of the interpolant of vals on the extrema grid"""
+    n, m = vals.shape[0]-1, vals.shape[1]-1
+    x, y = np.meshgrid(nodes(n), nodes(m), indexing='ij')
+    vander = chebyshev.chebvander2d(x.ravel(), y.ravel(), (n, m))
+    return np.linalg.solve(vander, vals.ravel()).reshape(n+1, m+1)
+
+
+def compute(task):
+    enu, cos_theta, kind, args = task
+    res = nuveto.passing(enu, cos_theta, kind, **args)
+    return res if args['rtol'] is None else res[0]
+
+
+def build(kind='conv_numu', enu_range=(1e2, 1e8), cos_theta_range=(0., 1.), target=1e-3, max_degree=64, nproc=1, **kwargs):
+    """Builds the surrogate of passing(enu, cos_theta, kind, **kwargs)
+
+    Args:
+        target (float): absolute error of the passing fraction on the held-out points
+        max_degree (int): maximal degree in each dimension, a power of 2
+        nproc (int): number of processes
+        kwargs: the other arguments of nuveto.passing
+    Returns:
+        Surrogate
+    """
+    args = nuveto.check(kwargs, 'Surrogates')
+    lenu_range = (np.log10(enu_range[0]), np.log10(enu_range[1]))
+    with nuveto.workers(nproc) as imap:
+        def fn(lenus, cths):
+            order = np.lexsort((lenus, cths))
+            vals = np.zeros(len(order))
+            vals[order] = list(imap(compute, [(10**lenus[idx], cths[idx], kind, args) for idx in order]))
+            return vals
+        coeffs, error = fit(fn, lenu_range, cos_theta_range, target, max_degree=max_degree)
+    return Surrogate(coeffs, lenu_range, cos_theta_range, error, kind, args)
@@ -0,0 +1,98 @@
+"""Resumable tables of passing fractions
+
+A table holds the passed and total fluxes on a (kind, cos_theta, enu) grid for
+fixed other arguments of nuveto.fluxes. Every computed cell is checkpointed to
+a ResultStore next to the table as soon as it is done, so a build that is
+interrupted resumes where it stopped and extending an axis only computes the
+new cells.
+"""
+
+import pickle
+import numpy as np
+from nuVeto import nuveto, datafile
+from nuVeto.store import ResultStore
+
+
+def load(fpath):
+    """Returns the table in fpath as a dict of enus, cos_thetas, kinds, passed,
+    total, the fluxes arguments args and the number of cells computed by the
+    build that wrote it
+    """
+    with open(fpath, 'rb') as f:
+        return pickle.load(f)
+
+
+def dump(table, fpath):
+    with datafile.atomic(fpath) as f:
+        pickle.dump(table, f, pickle.HIGHEST_PROTOCOL)
+
+
+def compute(task):
+    enu, cos_theta, kinds, args = task
+    res = nuveto.fluxes(enu, cos_theta, kinds, **args)
+    return enu, cos_theta, res if args['rtol'] is None else res[0]
+
+
+def build(fpath, enus, cos_thetas, kinds=('conv_numu',), nproc=1, checkpoint=None, **kwargs):
+    """Builds the table of fluxes(enu, cos_theta, kind, **kwargs) and writes it to fpath
+
+    Cells already in the checkpoint are not recomputed, so calling build again
+    after an interruption, or with more enus, cos_thetas or kinds, only
+    computes the missing cells.
+
+    Args:
+        fpath (str): the table, a pickle written atomically once complete
+        kinds (list(str)): the neutrino kinds, computed together
+        nproc (int): number of processes
+        checkpoint (str): the ResultStore of the computed cells, defaults to fpath+'.sqlite'
+        kwargs: the other arguments of nuveto.fluxes
+    Returns:
+        the table, see load
+    """
+    if checkpoint is None:
+        checkpoint = fpath+'.sqlite'
+    enus = np.sort(np.unique(enus))
+    cos_thetas = np.sort(np.unique(cos_thetas))
+    kinds = list(kinds)
+    store = ResultStore(checkpoint)
+    args = nuveto.check(kwargs, 'Tables')
+
+    cells = [(kind, cos_theta, enu) for kind in kinds for cos_theta in cos_thetas for enu in enus]
+    vals = store.get_many([dict(args, kind=kind, cos_theta=cos_theta, enu=enu)
+                           for kind, cos_theta, enu in cells])
+    todo = {}
+    for (kind, cos_theta, enu), val in zip(cells, vals):
+        if val is None:
+            todo.setdefault((cos_theta, enu), []).append(kind)
+    if todo:
+        tasks = [(enu, cos_theta, todo[cos_theta, enu], args) for cos_theta, enu in sorted(todo)]
+        with nuveto.workers(nproc) as imap:
+            for enu, cos_theta, res in imap(compute, tasks):
+                # checkpoint
+                store.put_many([(dict(args, kind=kind, cos_theta=cos_theta, enu=enu), val)
+                                for kind, val in res.items()])
+        vals = store.get_many([dict(args, kind=kind, cos_theta=cos_theta, enu=enu)
+                               for kind, cos_theta, enu in cells])
+
+    vals = np.reshape(vals, (len(kinds), len(cos_thetas), len(enus), 2))
+    table = {'enus':enus, 'cos_thetas':cos_thetas, 'kinds':kinds,
+             'passed':vals[..., 0], 'total':vals[..., 1], 'args':args,
+             'computed':sum(len(val) for val in todo.values())}
+    dump(table, fpath)
+    return table
+
+
+def extend(fpath, enus=(), cos_thetas=(), kinds=(), nproc=1, checkpoint=None):
+    """Adds enus, cos_thetas or kinds to the table in fpath, computing only the new cells"""
+    table = load(fpath)
+    # the table itself seeds the checkpoint
+    ResultStore(fpath+'.sqlite' if checkpoint is None else checkpoint).put_many(
+        [(dict(table['args'], kind=kind, cos_theta=cos_theta, enu=enu),
+          (table['passed'][ikind, icth, ienu], table['total'][ikind, icth, ienu]))
+         for ikind, kind in enumerate(table['kinds'])
+         for icth, cos_theta in enumerate(table['cos_thetas'])
+         for ienu, enu in enumerate(table['enus'])])
+    return build(fpath, np.concatenate([table['enus'], enus]),
+                 np.concatenate([table['cos_thetas'], cos_thetas]),
+                 table['kinds']+[kind for kind in kinds if kind not in table['kinds']],
+                 nproc, checkpoint, **table['args'])
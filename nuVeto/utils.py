@@ -1,11 +1,59 @@
 import os
-import pickle
-from pkg_resources import resource_filename
-from MCEq.geometry import EarthGeometry
-from mceq_config import config
+import importlib
 import numpy as np
-from scipy import stats
-import ParticleDataTool
+from scipy import stats, interpolate
+from nuVeto import datafile
+
+
+class LazyModule(object):
+    """Defers importing a module until one of its attributes is accessed"""
+    def __init__(self, *names):
+        """
+        Args:
+            names (str): module names, the first one that imports is used
+        """
+        self._names = names
+        self._module = None
+
+
+    def __getattr__(self, attr):
+        if attr.startswith('_'):
+            raise AttributeError(attr)
+        if self._module is None:
+            for name in self._names:
+                try:
+                    self._module = importlib.import_module(name)
+                    break
+                except ImportError:
+                    if name == self._names[-1]:
+                        raise
+        return getattr(self._module, attr)
+
+
+class lazy_property(object):
+    """Class attribute that is computed on first access and then cached"""
+    def __init__(self, fn):
+        self.fn = fn
+
+
+    def __get__(self, obj, cls):
+        val = self.fn()
+        setattr(cls, self.fn.__name__, val)
+        return val
+
+
+ParticleDataTool = LazyModule('ParticleDataTool')
+mceq_config = LazyModule('mceq_config')
+
+
+class mceq_setting(object):
+    """Class attribute read from the MCEq config on access"""
+    def __init__(self, name):
+        self.name = name
+
+
+    def __get__(self, obj, cls):
+        return mceq_config.config[self.name]
 
 
 class Units(object):
@@ -22,26 +70,43 @@ class Units(object):
     MeV = 1e-3*GeV
     TeV = 1.e3*GeV
     PeV = 1.e3*TeV
-    mol_air = config['A_target']
+    mol_air = mceq_setting('A_target')
     phim2 = (m**2*GeV*sec)**-1
     phicm2 = (cm**2*GeV*sec)**-1
 
 
 class ParticleProperties(object):
-    modtab = ParticleDataTool.SibyllParticleTable()
-    pd = ParticleDataTool.PYTHIAParticleData()
-    
-    mass_dict = {}; lifetime_dict = {}; pdg_id = {}; sibling = {};
+    """Particle properties from a bundled snapshot of ParticleDataTool
+
+    The snapshot holds the pdg ids, masses and lifetimes of the SIBYLL
+    particle table as well as rr and br_2body for every mother-neutrino pair,
+    so the PYTHIA particle data are only parsed for pairs missing from it.
+    See ParticleProperties.dump to regenerate it.
+    """
+    _snapshot = datafile.load('particles').meta
+    pdg_id = dict((str(k), v) for k, v in _snapshot['pdg_id'].items())
+    mass_dict = dict((str(k), v * Units.GeV) for k, v in _snapshot['mass'].items())
+    lifetime_dict = dict((str(k), v * Units.cm) for k, v in _snapshot['ctau'].items())
+    sibling = {}
+
+    @lazy_property
+    def modtab():
+        return ParticleDataTool.SibyllParticleTable()
+
+
+    @lazy_property
+    def pd():
+        return ParticleDataTool.PYTHIAParticleData()
 
-    for k in modtab.part_table:
-        pdg_id[k] = modtab.modname2pdg[k]
-        mass_dict[k] = pd.mass(pdg_id[k]) * Units.GeV
-        lifetime_dict[k] = pd.ctau(pdg_id[k]) * Units.cm
 
     @staticmethod
     def rr(mother, daughter):
         """ returns ratio of masses
         """
+        try:
+            return ParticleProperties._snapshot['rr'][mother][daughter]
+        except KeyError:
+            pass
         other_masses = []
         mother_pdg = ParticleProperties.pdg_id[mother]
         daughter_pdg = ParticleProperties.pdg_id[daughter]
@@ -58,6 +123,10 @@ class ParticleProperties(object):
     def br_2body(mother, daughter):
         """ returns the two-body branching ratio if it exists
         """
+        try:
+            return ParticleProperties._snapshot['br_2body'][mother][daughter]
+        except KeyError:
+            pass
         mother_pdg = ParticleProperties.pdg_id[mother]
         daughter_pdg = ParticleProperties.pdg_id[daughter]
         brs = 0
@@ -67,14 +136,50 @@ class ParticleProperties(object):
         return brs
 
 
+    @staticmethod
+    def pdg2modname(pdg_id):
+        """ returns the SIBYLL name of a pdg id
+        """
+        return str(ParticleProperties._snapshot['pdg2modname'][str(pdg_id)])
+
+
+    @staticmethod
+    def dump(fpath):
+        """ Writes the snapshot of the particle properties from ParticleDataTool
+        """
+        modtab = ParticleDataTool.SibyllParticleTable()
+        pd = ParticleDataTool.PYTHIAParticleData()
+        snapshot = {'pdg_id':{}, 'mass':{}, 'ctau':{}, 'rr':{}, 'br_2body':{},
+                    'pdg2modname':dict((str(k), v) for k, v in modtab.pdg2modname.items())}
+        for k in modtab.part_table:
+            snapshot['pdg_id'][k] = modtab.modname2pdg[k]
+            snapshot['mass'][k] = pd.mass(modtab.modname2pdg[k])
+            snapshot['ctau'][k] = pd.ctau(modtab.modname2pdg[k])
+        nus = ['nue', 'antinue', 'numu', 'antinumu', 'nutau', 'antinutau']
+        for mother in modtab.part_table:
+            for daughter in nus:
+                mother_pdg = modtab.modname2pdg[mother]
+                daughter_pdg = modtab.modname2pdg[daughter]
+                if mother in nus or not any(daughter_pdg in prod for br, prod in pd.decay_channels(mother_pdg)):
+                    continue
+                other_masses = [sum([pd.mass(abs(p)) for p in prod])-pd.mass(daughter_pdg)
+                                for br, prod in pd.decay_channels(mother_pdg) if daughter_pdg in prod]
+                snapshot['rr'].setdefault(mother, {})[daughter] = (
+                    min(other_masses)/pd.mass(mother_pdg))**2
+                snapshot['br_2body'].setdefault(mother, {})[daughter] = sum(
+                    [br for br, prod in pd.decay_channels(mother_pdg)
+                     if daughter_pdg in prod and len(prod) == 2])
+        datafile.write(fpath, {}, snapshot)
+
+
 class MuonProb(object):
     def __init__(self, pklfile):
         if pklfile is None:
             self.mu_int = self.median_approx
         elif os.path.isfile(pklfile):
-            self.mu_int = pickle.load(open(pklfile))
+            self.mu_int = datafile.load(pklfile).unpack()
         else:
-            self.mu_int = pickle.load(open(resource_filename('nuVeto', os.path.join('data', 'prpl', pklfile+'.pkl'))))
+            self.mu_int = datafile.load(os.path.join('prpl', pklfile)).unpack()
 
 
     def median_emui(self, distance):
@@ -102,19 +207,52 @@ class MuonProb(object):
         return pdets
         
     
-class Geometry(EarthGeometry):
+class DecayKernel(object):
+    """Interpolated dN/dE(x) of the daughter from the decay of a mother"""
+    def __init__(self, x_range, dNdEE, x_knots, dNdEE_knots, x_max):
+        """
+        Args:
+            x_range, dNdEE: the MCEq decay yield on its grid of x = E_daughter/E_mother
+            x_knots, dNdEE_knots: the increasing knots of the interpolant
+            x_max (float): the kinematic limit 1-rr
+        """
+        self.x_range = x_range
+        self.dNdEE = dNdEE
+        self.x_knots = x_knots
+        self.dNdEE_knots = dNdEE_knots
+        self.x_max = x_max
+        self.pchip = interpolate.PchipInterpolator(x_knots, dNdEE_knots, extrapolate=True)
+
+
+    def __call__(self, x):
+        return self.pchip(x) * np.heaviside(self.x_max-x, 1)
+
+
+class Geometry(object):
+    """The MCEq EarthGeometry in natural units with a detector at depth
+
+    MCEq.geometry is imported on the first Geometry, attributes not defined
+    here are the ones of the EarthGeometry.
+    """
     def __init__(self, depth):
         """ Depth of detector and elevation of surface above sea-level
         """
-        super(Geometry, self).__init__()
+        from MCEq.geometry import EarthGeometry
+        self.earth = EarthGeometry()
         self.depth = depth
-        self.h_obs *= Units.cm
-        self.h_atm *= Units.cm
-        self.r_E *= Units.cm
+        self.earth.h_obs *= Units.cm
+        self.earth.h_atm *= Units.cm
+        self.earth.r_E *= Units.cm
         self.r_top = self.r_E + self.h_atm
         self.r_obs = self.r_E + self.h_obs
 
 
+    def __getattr__(self, attr):
+        if attr == 'earth':
+            raise AttributeError(attr)
+        return getattr(self.earth, attr)
+
+
     def overburden(self, cos_theta):
         """Returns the overburden for a detector at *depth* below some surface
         at *elevation*.
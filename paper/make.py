@@ -1,6 +1,169 @@
 #!/usr/bin/env python
+"""
+Makes the figures for the paper
+
+The passing fractions and fluxes behind each figure are collected with a dry
+run of its fig_* function, deduplicated across figures and computed once in
+parallel. Results are persisted in the result store fig/cache.sqlite and a
+figure is only re-rendered when its code or its inputs change.
+"""
+import os
+import inspect
+import pickle
+import hashlib
 import argparse
+from multiprocessing import Pool
+import numpy as np
+from matplotlib import pyplot as plt
 import paper
+from nuVeto.examples import plots
+from nuVeto import nuveto, datafile
+from nuVeto.store import ResultStore, key
+
+
+CACHE = 'fig/cache.sqlite'
+STAMPS = 'fig/stamps.pkl'
+
+
+def fluxes_args(fn, *args, **kwargs):
+    """ Maps a call to nuveto.passing or nuveto.fluxes onto the arguments of
+    nuveto.fluxes and whether the fraction was requested
+    """
+    callargs = inspect.getcallargs(fn, *args, **kwargs)
+    fraction = callargs.pop('fraction', None)
+    callargs.pop('store')
+    return callargs, fraction
+
+
+class Recorder(object):
+    """ Stands in for passing and fluxes to record the requested points
+    """
+    def __init__(self):
+        self.requests = {}
+
+    def passing(self, *args, **kwargs):
+        callargs, fraction = fluxes_args(nuveto.passing, *args, **kwargs)
+        self.requests[key(**callargs)] = callargs
+        return 0.5 if fraction else 1.
+
+    def fluxes(self, *args, **kwargs):
+        callargs, _ = fluxes_args(nuveto.fluxes, *args, **kwargs)
+        self.requests[key(**callargs)] = callargs
+        return 1., 1.
+
+
+class Cached(object):
+    """ Stands in for passing and fluxes to look up precomputed points
+    """
+    def __init__(self, store):
+        self.store = store
+
+    def fluxes(self, *args, **kwargs):
+        callargs, _ = fluxes_args(nuveto.fluxes, *args, **kwargs)
+        return nuveto.fluxes(store=self.store, **callargs)
+
+    def passing(self, *args, **kwargs):
+        callargs, fraction = fluxes_args(nuveto.passing, *args, **kwargs)
+        num, den = self.fluxes(**callargs)
+        return num/den if fraction else num
+
+
+def patched(fig, passing, fluxes, dry_run=False):
+    """ Runs fig with passing and fluxes replaced
+    """
+    saved = (plots.passing, paper.fluxes, paper.save, paper.earth_attenuation, plt.savefig)
+    plots.passing = passing
+    paper.fluxes = fluxes
+    if dry_run:
+        paper.save = lambda fname: None
+        plt.savefig = lambda *args, **kwargs: None
+        paper.earth_attenuation = lambda enu, cos_theta, kind='conv_numu': np.ones(np.shape(enu))
+    try:
+        getattr(paper, fig)()
+    finally:
+        plots.passing, paper.fluxes, paper.save, paper.earth_attenuation, plt.savefig = saved
+        plt.close('all')
+
+
+def requests(fig):
+    """ Returns the fluxes calls that fig depends on, or None if the dry run fails
+    """
+    recorder = Recorder()
+    try:
+        patched(fig, recorder.passing, recorder.fluxes, dry_run=True)
+    except Exception as e:
+        print('Could not collect the inputs of {}: {}'.format(fig, e))
+        return None
+    return recorder.requests
+
+
+def compute(callargs):
+    return callargs, nuveto.fluxes(**callargs)
+
+
+def load(fname):
+    try:
+        with open(fname, 'rb') as f:
+            return pickle.load(f)
+    except IOError:
+        return {}
+
+
+def dump(obj, fname):
+    if not os.path.isdir(os.path.dirname(fname)):
+        os.makedirs(os.path.dirname(fname))
+    with datafile.atomic(fname) as f:
+        pickle.dump(obj, f)
+
+
+def fingerprint(fig, reqs, store):
+    md5 = hashlib.md5(inspect.getsource(getattr(paper, fig)).encode())
+    keys = sorted(reqs)
+    for k, val in zip(keys, store.get_many([reqs[k] for k in keys])):
+        md5.update(repr((k, val)).encode())
+    return md5.hexdigest()
+
+
+def make(figs, nproc=1, force=False):
+    if not os.path.isdir('fig'):
+        os.makedirs('fig')
+    store = ResultStore(CACHE)
+    stamps = load(STAMPS)
+    reqs = dict((fig, requests(fig)) for fig in figs)
+
+    todo = {}
+    for fig_reqs in reqs.values():
+        if fig_reqs:
+            todo.update(fig_reqs)
+    todo = [callargs for callargs, val in zip(todo.values(), store.get_many(todo.values()))
+            if val is None]
+    if todo:
+        print('Computing {} points for {} figures...'.format(len(todo), len(figs)))
+        # neighbouring points share a builder, keep them on the same worker
+        todo.sort(key=lambda callargs: repr(sorted(callargs.items())))
+        pool = Pool(nproc)
+        done = []
+        try:
+            for done_args in pool.imap(compute, todo, max(len(todo)//(4*nproc), 1)):
+                done.append(done_args)
+                if len(done) == 100:
+                    store.put_many(done)
+                    done = []
+        finally:
+            pool.close()
+            pool.join()
+            store.put_many(done)
+
+    cached = Cached(store)
+    for fig in figs:
+        stamp = None if reqs[fig] is None else fingerprint(fig, reqs[fig], store)
+        if not force and stamp is not None and stamps.get(fig) == stamp:
+            print('{} is up to date.'.format(fig))
+            continue
+        patched(fig, cached.passing, cached.fluxes)
+        stamps[fig] = stamp
+        dump(stamps, STAMPS)
+        print('Made {}.'.format(fig))
 
 
 if __name__ == '__main__':
@@ -8,12 +171,14 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Make plots for paper')
     parser.add_argument('-c', default=None, choices=figs, dest='choice',
                         help='Choice of figure to make. Defaults to all.')
+    parser.add_argument('-j', default=1, type=int, dest='nproc',
+                        help='Number of processes used to compute the inputs.')
+    parser.add_argument('-f', '--force', default=False, action='store_true',
+                        help='Re-render figures even if their inputs are unchanged.')
     args = parser.parse_args()
 
     if args.choice is None:
         print('Making all figures... this will take awhile')
-        for fig in figs:
-            getattr(paper, fig)()
-            print('Made {}.'.format(fig))
+        make(figs, args.nproc, args.force)
     else:
-        getattr(paper, args.choice)()
+        make([args.choice], args.nproc, args.force)
@@ -1,6 +1,5 @@
 import os
 import sys
-from pkg_resources import resource_filename
 from nuVeto.examples import plots
 from nuVeto.resources.mu import mu
 from nuVeto.external import selfveto as extsv
@@ -54,9 +53,9 @@ def earth_attenuation(enu, cos_theta, kind='conv_numu'):
 
         
 def fig_prpl():
-    step1000 = resource_filename('nuVeto', 'data/prpl/ice_allm97_step_1.pkl')
-    step750 = resource_filename('nuVeto', 'data/prpl/ice_allm97_step_0.75.pkl')
-    sigmoid = resource_filename('nuVeto', 'data/prpl/ice_allm97_sigmoid_0.75_0.25.pkl')
+    step1000 = 'prpl/ice_allm97_step_1'
+    step750 = 'prpl/ice_allm97_step_0.75'
+    sigmoid = 'prpl/ice_allm97_sigmoid_0.75_0.25'
     plt.figure()
     plots.plot_prpl(step1000, True, False)
     plt.title(r'Heaviside $\cal P_{\rm light}$')
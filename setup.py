@@ -10,16 +10,18 @@ setup(
     url='https://github.com/tianluyuan/nuVeto.git',
     packages=find_packages('./'),
     package_data={
-        'nuVeto':['data/decay_distributions/*.npz','data/prpl/*.pkl','data/corsika/*.pkl'],
+        'nuVeto':['data/*.nvd','data/*/*.nvd'],
         'nuVeto.resources.mu':['mmc/ice*.pklz']
     },
     install_requires=['numpy',
                       'scipy',
                       'functools32',
+                      'futures',
                       'MCeq'],
     extras_require={
         'plotting':  ['matplotlib', 'pandas'],
         'resources':  ['pythia8', 'matplotlib', 'argparse', 'pandas'],
+        'jit':  ['numba'],
     },
     setup_requires=['pytest-runner'],
     tests_require=['pytest']
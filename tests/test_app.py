@@ -1,11 +1,27 @@
 import os
+import sys
+import subprocess
+import tempfile
+import pickle
 from pkg_resources import resource_filename
 import numpy as np
-from scipy import interpolate
+from scipy import interpolate, integrate
 from nuVeto.external import helper as exthp
 from nuVeto.external import selfveto as extsv
+from nuVeto import nuveto
 from nuVeto.nuveto import passing, fluxes, nuVeto
-from nuVeto.utils import Geometry, Units, amu, MuonProb
+from nuVeto.store import ResultStore
+from nuVeto import ensemble
+from concurrent.futures import ThreadPoolExecutor
+from nuVeto.evaluator import Evaluator
+from nuVeto import table
+from nuVeto import surrogate
+from nuVeto import kernels
+from nuVeto import datafile
+from nuVeto import binned
+from nuVeto.utils import Geometry, Units, amu, MuonProb, ParticleProperties
+from nuVeto.resources.mu import mu, reaching
+from nuVeto.resources.decay import decay
 try:
     import CRFluxModels.CRFluxModels as pm
 except ImportError:
@@ -38,6 +54,23 @@ def test_overburden():
     assert np.all(center.overburden(cosths) == geom.r_E/Units.m)
 
 
+def test_particle_snapshot():
+    import ParticleDataTool
+    pd = ParticleDataTool.PYTHIAParticleData()
+    for mother, daughter in [('pi+', 'numu'), ('K0L', 'antinue'), ('D+', 'numu'), ('mu-', 'numu')]:
+        mother_pdg = ParticleProperties.pdg_id[mother]
+        assert np.isclose(ParticleProperties.mass_dict[mother], pd.mass(mother_pdg)*Units.GeV)
+        assert np.isclose(ParticleProperties.lifetime_dict[mother], pd.ctau(mother_pdg)*Units.cm)
+        assert 0 < ParticleProperties.rr(mother, daughter) < 1
+    assert ParticleProperties.br_2body('pi+', 'numu') > 0.99
+    assert np.isclose(ParticleProperties.br_2body('K+', 'numu'), 0.635, rtol=0.01)
+    # importing nuveto should not pull in MCEq or the CR models, nor need them
+    modules = subprocess.check_output([sys.executable, '-c', 'import sys; import nuVeto.nuveto; print(sorted(sys.modules))'])
+    assert b"'MCEq" not in modules and b"'mceq_config'" not in modules and b'CRFluxModels' not in modules
+    subprocess.check_call([sys.executable, '-c', "import sys; sys.modules['MCEq'] = sys.modules['mceq_config'] = None; "
+                           "import nuVeto.nuveto"])
+
+
 def test_pdet():
     l_ice = np.linspace(1000, 200000, 500)
     emui = np.logspace(3, 8, 500)*Units.GeV
@@ -49,6 +82,34 @@ def test_pdet():
         assert np.all(pdets >=0) and np.all(pdets <=1)
     
 
+# stand-in for MMC, echoes the input and appends a final energy
+MMC = """
+import sys
+import numpy as np
+rs = np.random.RandomState(0)
+for line in sys.stdin:
+    ei, l = map(float, line.split())
+    print ei, l, ei*rs.uniform()-l/4.
+"""
+
+
+def test_preach_stream():
+    kwargs = dict(nsamples=50, emuis=np.logspace(3, 5, 4), distances=np.linspace(1e3, 1e4, 3))
+    with tempfile.TemporaryFile() as raw:
+        mmc = subprocess.Popen([sys.executable, '-c', MMC], stdin=subprocess.PIPE, stdout=raw)
+        reaching.generate(mmc.stdin, **kwargs)
+        mmc.stdin.close()
+        mmc.wait()
+        raw.seek(0)
+        stored = mu.hist_preach(raw)
+
+    mmc = subprocess.Popen([sys.executable, '-c', MMC], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    reaching.generate(mmc.stdin, **kwargs)
+    mmc.stdin.close()
+    streamed = mu.hist_preach_stream(mmc.stdout, chunksize=97)
+    assert np.allclose(stored, streamed)
+
+
 def test_pnmshower():
     cths = [0.1, 0.3, 0.8]
     particle = 14
@@ -74,6 +135,352 @@ def test_pnmsib():
                 assert np.all(0 <= psibs) and np.all(psibs <= 1)
 
 
+def test_decay_distributions():
+    for mother in decay.CHANNELS:
+        hists = decay.histograms(mother, 100000, nproc=2)
+        assert np.array_equal(np.nan_to_num(hists),
+                              np.nan_to_num(decay.histograms(mother, 100000, nproc=1)))
+        dfile = datafile.load('decay_distributions/{}_numu'.format(decay.CHANNELS[mother][1]))
+        assert hists.shape == dfile['histograms'].shape
+        filled = np.all(np.isfinite(hists), axis=1)
+        assert np.allclose(np.sum(hists[filled], axis=1), 1)
+    # n decays, the last chunk holds the remainder
+    xedges = np.linspace(0, 1, 11)
+    hist = sum(size*decay.hist_chunk(('K+', size, chunk, 0, 1e3, xedges)) for chunk, size in enumerate([100, 100, 50]))
+    with np.errstate(invalid='ignore'):
+        assert np.allclose(decay.histograms('K+', 250, chunksize=100, xedges=xedges)[:-1],
+                           hist/hist.sum(axis=1, keepdims=True), equal_nan=True)
+
+
+def test_decay_kernels(tmpdir, monkeypatch):
+    monkeypatch.setenv('NUVETO_CACHE', str(tmpdir))
+    sv = nuVeto(0.5)
+    nuveto._decay_kernels.clear()
+    built = nuveto.decay_kernels(sv.mceq)
+    nuveto._decay_kernels.clear()
+    loaded = nuveto.decay_kernels(sv.mceq)
+    assert set(built) == set(loaded)
+    x = np.logspace(-4, 0, 200)
+    for pair in built:
+        assert np.all(built[pair](x) == loaded[pair](x))
+    assert np.all(built['K+', 'numu'](x[x > 1-ParticleProperties.rr('K+', 'numu')]) == 0)
+
+
+def test_fluxes_depths():
+    depths = np.asarray([1450, 1950, 2450])*Units.m
+    nbuilt = nuveto.builder.cache_info().currsize
+    res = nuveto.fluxes_depths(1e5, 1., depths, accuracy=1)
+    # the effective zenith is the same at all depths for vertical events
+    assert nuveto.builder.cache_info().currsize - nbuilt <= 1
+    for depth, (passed, total) in zip(depths, res):
+        assert np.allclose((passed, total), fluxes(1e5, 1., depth=depth, accuracy=1))
+    assert res[0][0] < res[-1][0]
+
+
+def test_prpls():
+    prpls = ['ice_allm97_step_1', None, 'ice_allm97_sigmoid_0.75_0.1']
+    for kind in ['conv_numu', 'pr_nue']:
+        for corr_only in [False, True]:
+            res = fluxes(1e4, 0.5, kind, accuracy=1, prpl=prpls, corr_only=corr_only)
+            for prpl, val in zip(prpls, res):
+                assert np.allclose(val, fluxes(1e4, 0.5, kind, accuracy=1, prpl=prpl, corr_only=corr_only))
+
+
+def test_kinds():
+    kinds = ['conv_numu', 'pr_numu', 'total_numu', 'conv_antinue', 'total_nutau']
+    for corr_only in [False, True]:
+        res = fluxes(2e4, 0.5, kinds, accuracy=1, corr_only=corr_only)
+        for kind in kinds:
+            assert np.allclose(res[kind], fluxes(2e4, 0.5, kind, accuracy=1, corr_only=corr_only))
+        assert np.allclose(np.add(res['conv_numu'], res['pr_numu']), res['total_numu'])
+    fracs = passing(2e4, 0.5, kinds[:2], accuracy=1, prpl=['ice_allm97_step_1', None])
+    assert len(fracs['pr_numu']) == 2
+
+
+def test_ensemble(tmpdir):
+    configs = [{'label':'step'},
+               {'label':'median', 'prpl':None},
+               {'label':'deep', 'depth':2450*Units.m},
+               {'label':'prompt', 'kind':'pr_numu', 'barr_mods':[]}]
+    enus = [1e4, 1e5]
+    cths = [0.3, 0.8]
+    groups = ensemble.tasks([dict([arg for arg in config.items() if arg[0] != 'label'], accuracy=1)
+                             for config in configs], cths)
+    # the step, median and prompt configurations share the MCEq runs and a single fluxes call
+    assert sorted(len(calls[0][1]) for build, calls in groups) == [1, 1, 3, 3]
+    res = ensemble.run([dict(config, accuracy=1) for config in configs], enus, cths, nproc=2)
+    assert res.passed.shape == (4, 2, 2)
+    for iconf, config in enumerate(configs):
+        args = dict((arg, ensemble.freeze(val)) for arg, val in config.items() if arg != 'label')
+        args['accuracy'] = 1
+        for icth, cth in enumerate(cths):
+            for ienu, enu in enumerate(enus):
+                assert np.isclose(res[config['label']][icth, ienu], passing(enu, cth, **args))
+    summary = res.summary()
+    assert np.all(summary['min'] <= summary['mean']) and np.all(summary['mean'] <= summary['max'])
+    shared = ensemble.run([dict(config, accuracy=1) for config in configs], enus, cths, nproc=2,
+                          solutions=str(tmpdir))
+    assert np.allclose(shared.passed, res.passed) and np.allclose(shared.total, res.total)
+
+
+def test_publish(tmpdir):
+    path = str(tmpdir)
+    sv = nuVeto(0.6, depth=1850*Units.m)
+    sv.publish(path, accuracy=1)
+    ecr = sv.ecrs(14, 1)[5]
+    attached = nuVeto(0.6, depth=1850*Units.m)
+    attached.attach(path)
+    sol = attached.grid_sol(ecr, 14)
+    assert isinstance(sol, np.memmap) and not sol.flags.writeable
+    assert np.all(sol == np.asarray(sv.solve(ecr, 14)))
+    assert np.allclose(attached.get_fluxes(1e4, accuracy=1), sv.get_fluxes(1e4, accuracy=1))
+
+
+def test_evaluator(tmpdir):
+    with Evaluator(4) as ev:
+        futures = [ev.fluxes(enu, 0.4, accuracy=1) for enu in [1e4, 1e5]*4]
+        assert futures[0] is futures[2]
+        fracs = [ev.passing(1e4, cth, accuracy=1) for cth in [0.4, 0.7]]
+        for future, enu in zip(futures, [1e4, 1e5]*4):
+            assert np.allclose(future.result(), fluxes(enu, 0.4, accuracy=1))
+        for future, cth in zip(fracs, [0.4, 0.7]):
+            assert np.isclose(future.result(), passing(1e4, cth, accuracy=1))
+    assert not ev.inflight
+    # a store is shared between threads through their own connections
+    store = ResultStore(str(tmpdir.join('threads.sqlite')))
+    with ThreadPoolExecutor(2) as pool:
+        res = list(pool.map(lambda enu: fluxes(enu, 0.4, accuracy=1, store=store), [1e4, 1e5]))
+    assert len(store) == 2 and res == [fluxes(enu, 0.4, accuracy=1) for enu in [1e4, 1e5]]
+
+
+def test_table(tmpdir):
+    fpath = str(tmpdir.join('table.pkl'))
+    kinds = ['conv_numu', 'pr_numu']
+    built = table.build(fpath, [1e4, 1e5], [0.5], kinds, accuracy=1)
+    assert built['computed'] == 4
+    # resuming from the checkpoint computes nothing
+    os.remove(fpath)
+    resumed = table.build(fpath, [1e4, 1e5], [0.5], kinds, accuracy=1)
+    assert resumed['computed'] == 0 and np.all(resumed['passed'] == built['passed'])
+    extended = table.extend(fpath, enus=[3e4])
+    assert extended['computed'] == 2
+    assert extended['passed'].shape == (2, 1, 3)
+    assert np.isclose(extended['passed'][1, 0, 1], fluxes(3e4, 0.5, 'pr_numu', accuracy=1)[0])
+    assert np.all(table.load(fpath)['total'] == extended['total'])
+
+
+def test_surrogate(tmpdir):
+    fn = lambda lenu, cth: 1/(1+np.exp(2*(lenu-4.5)*(0.5+cth)))
+    coeffs, error = surrogate.fit(fn, (2, 8), (0, 1), 1e-3)
+    assert error < 1e-3
+    sur = surrogate.Surrogate(coeffs, (2, 8), (0, 1), error)
+    lenus, cths = np.random.uniform(2, 8, 1000), np.random.uniform(0, 1, 1000)
+    assert np.max(np.abs(sur(10**lenus, cths)-fn(lenus, cths))) < 2e-3
+    assert np.isnan(sur(1e9, 0.5))
+    coeffs, error = surrogate.fit(fn, (2, 8), (0, 1), 1e-12, max_degree=16)
+    assert max(coeffs.shape) <= 17 and error > 1e-12
+    for max_degree in [48, 1]:
+        try:
+            surrogate.fit(fn, (2, 8), (0, 1), 1e-6, max_degree=max_degree)
+            assert False
+        except ValueError:
+            pass
+    fpath = str(tmpdir.join('pf.npz'))
+    sur.dump(fpath)
+    assert np.all(surrogate.Surrogate.load(fpath)(10**lenus, cths) == sur(10**lenus, cths))
+    sur = surrogate.build('conv_numu', (1e3, 1e5), (0.5, 1), 1e-2, max_degree=4, accuracy=1, corr_only=True)
+    assert np.isclose(sur(1e4, 0.75), passing(1e4, 0.75, accuracy=1, corr_only=True), atol=max(sur.error, 1e-2))
+
+
+def test_kernels(monkeypatch):
+    rng = np.random.RandomState(0)
+    for impl in [kernels.projectiles_loops, kernels.projectiles]:
+        res, ref = np.zeros((3, 5)), np.zeros((3, 5))
+        args = rng.rand(5, 5), rng.rand(3, 5), rng.rand(5), rng.rand(3)
+        impl(res, *args)
+        kernels.projectiles_numpy(ref, *args)
+        assert np.allclose(res, ref, rtol=1e-12)
+    pmu, pdet = rng.rand(4, 7), rng.rand(4, 7)
+    for impl in [kernels.reaching_loops, kernels.reaching]:
+        assert np.allclose(impl(pmu, pdet), kernels.reaching_numpy(pmu, pdet), rtol=1e-12)
+    x = np.concatenate([rng.rand(20), [1., 2.]])
+    for differential in [False, True]:
+        ref = kernels.elbert_numpy(x, 3., 0.5, 1.6, 4.9, 0.58, differential)
+        for impl in [np.vectorize(kernels.elbert_scalar), kernels.elbert]:
+            assert np.allclose(impl(x, 3., 0.5, 1.6, 4.9, 0.58, differential), ref, rtol=1e-12)
+    monkeypatch.setenv('NUVETO_NUMBA', '0')
+    kernel = kernels.Kernel(kernels.reaching_numpy, None)
+    assert kernel.impl is None
+    assert np.all(kernel(pmu, pdet) == kernels.reaching_numpy(pmu, pdet))
+    assert kernel.impl is kernels.reaching_numpy
+
+
+def test_reduced():
+    sv = nuVeto(0.5)
+    esamp = sv.esamp(1e4, 1)
+    prpls = ['ice_allm97_step_1', None]
+    pnmarrs = np.random.RandomState(0).rand(2, len(esamp))
+    for kind in ['conv_numu', 'pr_nue']:
+        categ, daughter = kind.split('_')
+        # flux*yield on esamp
+        dens, nums = 0., [0., 0.]
+        for mother in sv.categ_to_mothers(categ, daughter):
+            phi = sv.sample_phi(mother, esamp, 1e6, 14)
+            dnde = sv.get_dNdEE(mother, daughter)[-1](1e4/esamp)/esamp
+            dens += dnde*phi
+            for iprpl, prpl in enumerate(prpls):
+                pnmsib = sv.psib(sv.geom.overburden(0.5), mother, 1e4, 1, prpl) if 'numu' in daughter else 1.
+                nums[iprpl] += dnde*pnmsib*phi
+        num, den = sv.get_reduced(categ, daughter, 1e4, 1, prpls, pnmarrs, 1e6, 14)
+        assert np.isclose(den, integrate.trapz(dens, esamp), rtol=1e-10)
+        assert np.allclose(num, [integrate.trapz(num_*pnmarr, esamp)
+                                 for num_, pnmarr in zip(nums, pnmarrs)], rtol=1e-10)
+
+
+def test_auto(tmpdir):
+    res, report = nuveto.converge(lambda accuracy: (1+1./accuracy**2, 1.), 0.1)
+    assert report['accuracies'] == [1, 1.9, 3.7, 7.3] and report['converged']
+    assert res == (1+1./7.3**2, 1.) and np.isclose(report['change'], (1./3.7**2-1./7.3**2)/(1+1./7.3**2))
+    assert not nuveto.converge(lambda accuracy: (accuracy, 1.), 1e-3)[1]['converged']
+    store = ResultStore(str(tmpdir.join('auto.sqlite')))
+    res, report = fluxes(1e4, 0.5, accuracy='auto', corr_only=True, auto_rtol=0.1, store=store)
+    assert report['converged'] and report['change'] <= 0.1 and 'pruning' not in report
+    assert res == fluxes(1e4, 0.5, accuracy=report['accuracy'], corr_only=True)
+    assert len(store) == len(report['accuracies'])
+    frac, report = passing(1e4, 0.5, accuracy='auto', corr_only=True, auto_rtol=0.1, store=store)
+    assert frac == res[0]/res[1] and len(store) == len(report['accuracies'])
+    # rtol prunes each accuracy
+    pruned, report = fluxes(1e4, 0.5, accuracy='auto', corr_only=True, auto_rtol=0.1, rtol=1e-2)
+    assert report['pruning']['rtol'] == 1e-2
+    assert pruned == fluxes(1e4, 0.5, accuracy=report['accuracy'], corr_only=True, rtol=1e-2)[0]
+
+
+def test_datafile(tmpdir):
+    fpath = str(tmpdir.join('intp.pkl'))
+    intp = interpolate.RegularGridInterpolator((np.arange(3.), np.linspace(0, 1, 5)), np.random.rand(3, 5),
+                                               bounds_error=False, fill_value=None)
+    with open(fpath, 'wb') as f:
+        pickle.dump(intp, f)
+    converted = datafile.load(datafile.convert(fpath))
+    assert isinstance(converted['values'], np.memmap)
+    pts = np.random.rand(10, 2)*[3, 1]
+    assert np.array_equal(converted.unpack()(pts), intp(pts))
+    assert np.array_equal(datafile.load(fpath).unpack()(pts), intp(pts))
+    assert np.array_equal(MuonProb(fpath[:-4]+datafile.EXT).mu_int(pts), intp(pts))
+    # every bundled resource is in the current format
+    for dirpath, dirnames, fnames in os.walk(resource_filename('nuVeto', 'data')):
+        for fname in fnames:
+            assert datafile.read(os.path.join(dirpath, fname)).version == datafile.VERSION
+    assert datafile.load('corsika/eff_maxmu').unpack()['conv_numu'][0].shape == (20, 10)
+    # an interrupted write leaves the previous file
+    files = sorted(os.listdir(str(tmpdir)))
+    try:
+        with datafile.atomic(fpath) as f:
+            f.write(b'partial')
+            raise ValueError
+    except ValueError:
+        pass
+    assert sorted(os.listdir(str(tmpdir))) == files
+    with open(fpath, 'rb') as f:
+        assert np.array_equal(pickle.load(f)(pts), intp(pts))
+
+
+def test_cos_theta_bins(tmpdir):
+    for order in [1, 2, 4, 8]:
+        nodes, weights = binned.clenshaw_curtis(order)
+        assert np.isclose(np.dot(weights, nodes**order), (1+(-1)**order)/(order+1.))
+    for order in [0, 3, 5]:
+        try:
+            binned.quadrature([0., 1.], order)
+            assert False
+        except ValueError:
+            pass
+    store = ResultStore(str(tmpdir.join('bins.sqlite')))
+    res = binned.cos_theta_bins([1e4, 1e5], [0.4, 0.7, 1.], order=2, store=store, accuracy=1, corr_only=True)
+    # the edge at 0.7 is shared
+    assert len(store) == 2*5
+    assert res['fraction'].shape == res['error'].shape == (2, 2)
+    nodes = [fluxes(1e4, cth, accuracy=1, corr_only=True) for cth in [0.4, 0.55, 0.7]]
+    simpson = np.dot([1, 4, 1], nodes)/6.
+    assert np.allclose([res['passed'][0, 0], res['total'][0, 0]], simpson)
+    assert np.isclose(res['fraction'][0, 0], simpson[0]/simpson[1])
+    assert np.all(res['error'] > 0)
+
+
+def test_enu_bins():
+    res = binned.enu_bins([1e4, 3e4, 1e5], 0.5, order=4, accuracy=1, corr_only=True)
+    assert res['fraction'].shape == res['error'].shape == (2,)
+    enus = np.logspace(4, np.log10(3e4), 41)
+    vals = np.array([fluxes(enu, 0.5, accuracy=1, corr_only=True) for enu in enus])
+    total = integrate.trapz(vals[:,1], enus)
+    assert np.isclose(res['total'][0], total/2e4, rtol=1e-2)
+    assert np.isclose(res['fraction'][0], integrate.trapz(vals[:,0], enus)/total, atol=5e-3)
+    # the flux-weighted average lies between the fractions at the edges
+    edges = [passing(enu, 0.5, accuracy=1, corr_only=True) for enu in [1e4, 3e4]]
+    assert min(edges) <= res['fraction'][0] <= max(edges)
+
+
+def test_response():
+    sv = nuVeto(0.5)
+    kinds, prpls = ['conv_numu', 'total_numu'], ['ice_allm97_step_1', 'ice_allm97_step_1']
+    res = sv.get_response(1e5, kinds, 1, prpls)
+    exact = sv.get_fluxes(1e5, kinds, 1, prpls)
+    for kind in kinds:
+        assert np.allclose(res.fluxes(sv.pmodel)[kind], exact[kind], rtol=1e-10, atol=0)
+    reweighted = fluxes(1e5, 0.5, pmodel=('GaisserHonda', None), accuracy=1)
+    assert np.allclose(res.fluxes(('GaisserHonda', None))['conv_numu'][0], reweighted, rtol=1e-10, atol=0)
+    gh = getattr(nuveto.pm, 'GaisserHonda')(None)
+    arrays = dict((particle, gh.nucleus_flux(particle, res.ecrs[particle])) for particle in gh.nucleus_ids)
+    assert np.allclose(res.passing(arrays)['conv_numu'], res.passing(gh)['conv_numu'])
+    try:
+        res.fluxes({0:np.ones(3)})
+        assert False
+    except ValueError:
+        pass
+
+
+def test_depth_grids():
+    ref = nuVeto(0.5)
+    fine, coarse = nuVeto(0.5, xtol=1e-3), nuVeto(0.5, xtol=1e-2)
+    assert ref.X_grids == {} and 'pi' in fine.X_grids and 'D' in fine.X_grids
+    for sv in [fine, coarse]:
+        assert sv.X_vec[sv.surface] == ref.X_vec[-1]
+        for cols, widths in sv.X_grids.values():
+            assert np.isclose(np.sum(widths), sv.mceq.density_model.max_X-2e-3)
+            assert np.all(np.diff(sv.X_vec[cols]) > 0)
+    assert len(coarse.X_vec) < len(fine.X_vec)
+    res = [sv.get_fluxes(1e3, 'total_numu', 1) for sv in [ref, coarse, fine]]
+    assert np.isclose(res[1][1], res[2][1], rtol=1e-2)
+    assert np.isclose(res[2][0]/res[2][1], res[0][0]/res[0][1], rtol=1e-3)
+    assert nuveto.builder(0.5, ('HillasGaisser2012', 'H3a'), 'SIBYLL2.3c', (), 1950*Units.m,
+                          ('CORSIKA', ('SouthPole', 'June')), 1e-2).args[-1] == 1e-2
+
+
+def test_prune():
+    sv = nuVeto(0.5)
+    for enu in [1e3, 1e5]:
+        exact = sv.get_fluxes(enu, 'conv_numu', 2)
+        pruned, report = sv.get_fluxes(enu, 'conv_numu', 2, rtol=1e-3)
+        assert report['rtol'] == 1e-3 and not hasattr(sv, 'pruning')
+        assert sum(n for n, _ in report['ecrs'].values()) < sum(m for _, m in report['ecrs'].values())
+        assert np.allclose(pruned, exact, rtol=1e-3, atol=0)
+    frac, report = passing(1e5, 0.5, accuracy=2, rtol=1e-3)
+    assert np.isclose(frac, exact[0]/exact[1], rtol=2e-3) and report['ecrs']
+    assert sv.get_fluxes(1e5, 'conv_numu', 2, corr_only=True, rtol=1e-3)[1]['ecrs'] == {}
+
+
+def test_matrices():
+    sv = nuVeto(0.5)
+    assert sv.interpolation_matrix(1e5, 2).shape == (len(sv.esamp(1e5, 2)), len(sv.mceq.e_grid))
+    for enu in [1e3, 1e5]:
+        exact = sv.get_fluxes(enu, 'total_numu', 2, corr_only=True)
+        assert np.allclose(sv.get_fluxes(enu, 'total_numu', 2, corr_only=True, matrices=True), exact, rtol=1e-4)
+        exact = sv.get_fluxes(enu, 'total_numu', 2)
+        approx = sv.get_fluxes(enu, 'total_numu', 2, matrices=True)
+        assert np.isclose(approx[1], exact[1], rtol=1e-2)
+        assert np.isclose(approx[0]/approx[1], exact[0]/exact[1], rtol=0, atol=5e-3)
+
+
 def test_elbert():
     ens = np.logspace(2,9,50)
     cths = [0.1,0.3,0.8]
@@ -86,6 +493,16 @@ def test_elbert():
         assert np.all(np.abs(theirs-mine)<0.02)
 
 
+def test_selfveto_chunked():
+    enus, cths = np.meshgrid(np.logspace(2, 8, 51), np.linspace(0, 1, 21))
+    emus = extsv.minimum_muon_energy(extsv.overburden(cths))
+    for kind in ['numu', 'nue', 'charm']:
+        assert np.allclose(extsv.uncorrelated_passing_rate(enus, emus, cths, kind),
+                           extsv.uncorrelated_passing_rate(enus, emus, cths, kind, chunksize=100))
+    assert np.allclose(extsv.correlated_passing_rate(enus, emus, cths),
+                       extsv.correlated_passing_rate(enus, emus, cths, chunksize=100))
+
+
 def test_nuflux():
     cths = [0.1, 0.3, 0.8]
     kinds = ['conv_numu', 'conv_nue', 'pr_numu', 'pr_nue']
@@ -112,3 +529,23 @@ def test_nonneg():
             for enu in enus:
                 n, d = sv.get_fluxes(enu, kind)
                 assert n > 0 and d > 0
+
+
+def test_store(tmpdir):
+    store = ResultStore(str(tmpdir.join('results.sqlite')))
+    args = dict(enu=1e5, cos_theta=0.5, kind='conv_numu', pmodel=(pm.HillasGaisser2012, 'H3a'),
+                hadr='SIBYLL2.3c', barr_mods=(), depth=1950*Units.m,
+                density=('CORSIKA', ('SouthPole', 'June')), accuracy=1, prpl='ice_allm97_step_1',
+                corr_only=False)
+    assert store.get(**args) is None
+    res = fluxes(store=store, **args)
+    assert store.get(**args) == res
+    assert fluxes(store=store, **args) == res
+    # numerically equal arguments share an entry
+    assert store.get(**dict(args, enu=100000, accuracy=1.)) == res
+
+    grid = [dict(args, enu=enu) for enu in np.logspace(3, 4, 700)]
+    store.put_many([(kwargs, (kwargs['enu'], 1.)) for kwargs in grid])
+    assert [val[0] for val in store.get_many(grid)] == [kwargs['enu'] for kwargs in grid]
+    assert len(ResultStore(store.path)) == 701
+